@@ -3,23 +3,828 @@ import requests
 import time
 import subprocess
 import re
+import os
+import gzip
+import json
+import shutil
+import socket
+import struct
+import asyncio
+import select
 import threading
 import traceback
 import logging
+import random
+import heapq
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 SERVER_URL = 'http://172.17.0.1:50000'
+# Seconds an idle client lets the server hold a /get_commands request open
+COMMAND_WAIT = 25
+# How often to ask a server without partial mesh sampling (/get_targets) again
+SAMPLE_REFRESH = 60
+# Upper bound on concurrent probes when a round can't be handed to fping in one go
+PROBE_WORKERS = 32
+# 'auto' probes in-process over ICMP (datagram, then raw socket) and falls back to
+# UDP echo against the other clients' responders; 'icmp', 'udp' force a method
+# and 'ping' keeps forking the ping binary
+PROBE_METHOD = 'auto'
+PROBE_TIMEOUT = 0.8
+# Every target is probed once per PROBE_INTERVAL seconds on the monotonic clock,
+# at a fixed slot spread evenly over the interval, moved by up to
+# +/- PROBE_JITTER of the interval. Probes due within PROBE_BATCH_WINDOW of each
+# other go out together (PROBE_SUBPROCESS_WINDOW when each batch forks fping or ping).
+# Twice a second matches the sample density of the old round-and-sleep loop.
+PROBE_INTERVAL = 0.5
+PROBE_JITTER = 0.05
+PROBE_BATCH_WINDOW = 0.005
+PROBE_SUBPROCESS_WINDOW = 0.1
+# Threads running fping or ping batches: enough to start one batch every
+# PROBE_SUBPROCESS_WINDOW while earlier ones wait out PROBE_TIMEOUT
+PROBE_BATCH_WORKERS = math.ceil(PROBE_TIMEOUT / PROBE_SUBPROCESS_WINDOW) + 2
+# With ADAPTIVE_PROBING a target that keeps answering without latency jumps is
+# probed half as often after every PROBE_BACKOFF_AFTER clean results, down to
+# once every PROBE_BACKOFF_MAX intervals. A new failure or a latency jump (over
+# PROBE_JUMP_FACTOR times its running average and at least PROBE_JUMP_MIN ms
+# above it) switches the target to a burst of PROBE_BURST_COUNT probes every
+# PROBE_BURST_FACTOR intervals, then back to PROBE_INTERVAL. Targets that keep
+# failing stay at PROBE_INTERVAL.
+ADAPTIVE_PROBING = False
+PROBE_BACKOFF_AFTER = 10
+PROBE_BACKOFF_MAX = 16
+PROBE_BURST_FACTOR = 0.5
+PROBE_BURST_COUNT = 8
+PROBE_JUMP_FACTOR = 2.0
+PROBE_JUMP_MIN = 5.0
+# With AGGREGATE_WINDOW > 0 results are summarised per target over windows of
+# that many seconds (sent/lost, min/avg/max, jitter, a latency histogram and the
+# exact failure times) and one summary is sent per window instead of every
+# result. A window is sent AGGREGATE_GRACE seconds after it ends, so replies
+# still in flight make it in.
+AGGREGATE_WINDOW = 0
+AGGREGATE_GRACE = 2
+# Latency histogram buckets of the aggregates, the same logarithmic buckets the
+# server's LatencySketch uses
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_LOG_GAMMA = math.log((1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY))
+SKETCH_MIN_LATENCY = 0.001
+UDP_ECHO_PORT = 50007
+UDP_ECHO_MAGIC = b'NPT1'
+# Concurrent traceroutes run off the ping path on state changes
+TRACEROUTE_WORKERS = 4
+# 'auto' traces in-process with TTLTracer where the kernel supports it (Linux),
+# 'traceroute' runs the traceroute binary, TRACEROUTE_PARALLELISM at a time
+# during the initial and final sweeps
+TRACEROUTE_METHOD = 'auto'
+TRACEROUTE_PARALLELISM = 16
+TRACE_MAX_HOPS = 30
+TRACE_WAIT = 2.0
+TRACE_ATTEMPTS = 2
+TRACE_BASE_PORT = 33434
+# Rounds are buffered locally and shipped gzip-compressed in batches every
+# UPLOAD_INTERVAL seconds; failed uploads are retried with exponential backoff.
+# Beyond BUFFER_MEMORY_ROUNDS the buffer spills to BUFFER_SPILL_PATH.
+UPLOAD_INTERVAL = 2
+UPLOAD_BATCH_ROUNDS = 200
+UPLOAD_BACKOFF_MAX = 30
+BUFFER_MEMORY_ROUNDS = 1000
+BUFFER_SPILL_PATH = '/tmp/nodepathtest_buffer.ndjson'
+BUFFER_SPILL_MAX_BYTES = 64 * 1024 * 1024
+# Record types of the server's compact /ingest format
+RECORD_RESULT = 0
+RECORD_TRACEROUTE = 1
+RECORD_AGGREGATE = 2
+# Linux values, not exported by the socket module
+IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)
+SO_EE_ORIGIN_ICMP = 2
+UNREACH_FLAGS = {0: '!N', 1: '!H', 2: '!P', 4: '!F', 5: '!S', 9: '!X', 10: '!X', 13: '!X'}
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+class AsyncProber:
+    """Probes many targets over a single socket from an asyncio loop running in
+    a background thread. Replies are matched to requests by address and sequence
+    number and timed with time.monotonic_ns()."""
+
+    def __init__(self, method='auto', timeout=PROBE_TIMEOUT):
+        self.timeout = timeout
+        self.ident = os.getpid() & 0xffff
+        self.sequence = 0
+        self.pending = {}  # (target_ip, sequence) -> (future, sent_ns)
+        self.method, self.sock = self.open_socket(method)
+        self.sock.setblocking(False)
+        try:
+            # Room for a full round of replies arriving in a burst
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except OSError:
+            pass
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, name='prober', daemon=True)
+        self.thread.start()
+        logging.info(f"Probing with {self.method} sockets")
+
+    def open_socket(self, method):
+        if method in ('auto', 'icmp'):
+            # Unprivileged ICMP needs net.ipv4.ping_group_range, raw needs CAP_NET_RAW
+            for kind, sock_type in (('icmp', socket.SOCK_DGRAM), ('icmp-raw', socket.SOCK_RAW)):
+                try:
+                    return kind, socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+                except OSError:
+                    continue
+            if method == 'icmp':
+                raise OSError('No ICMP socket available')
+        return 'udp', socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_reader(self.sock, self.on_readable)
+        self.loop.run_forever()
+
+    def next_sequence(self):
+        self.sequence = (self.sequence + 1) & 0xffff
+        return self.sequence
+
+    def build_packet(self, sequence):
+        if self.method == 'udp':
+            return UDP_ECHO_MAGIC + struct.pack('!HH', self.ident, sequence)
+        header = struct.pack('!BBHHH', 8, 0, 0, self.ident, sequence)
+        payload = b'nodepathtest'
+        checksum = icmp_checksum(header + payload)
+        return struct.pack('!BBHHH', 8, 0, checksum, self.ident, sequence) + payload
+
+    def parse_reply(self, data):
+        # Returns the sequence number of an echo reply meant for us, or None
+        if self.method == 'udp':
+            if len(data) >= 8 and data[:4] == UDP_ECHO_MAGIC:
+                ident, sequence = struct.unpack('!HH', data[4:8])
+                if ident == self.ident:
+                    return sequence
+            return None
+        if self.method == 'icmp-raw':
+            # Raw sockets see the IP header and every ICMP packet on the host
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < 8:
+            return None
+        icmp_type, _, _, ident, sequence = struct.unpack('!BBHHH', data[:8])
+        if icmp_type != 0:
+            return None
+        # The kernel rewrites the identifier of datagram ICMP sockets
+        if self.method == 'icmp-raw' and ident != self.ident:
+            return None
+        return sequence
+
+    def on_readable(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            received_ns = time.monotonic_ns()
+            sequence = self.parse_reply(data)
+            if sequence is None:
+                continue
+            entry = self.pending.pop((address[0], sequence), None)
+            if entry:
+                future, sent_ns = entry
+                if not future.done():
+                    future.set_result((received_ns - sent_ns) / 1e6)
+
+    async def send(self, target_ip, packet):
+        port = UDP_ECHO_PORT if self.method == 'udp' else 0
+        for _ in range(50):
+            try:
+                self.sock.sendto(packet, (target_ip, port))
+                return True
+            except (BlockingIOError, InterruptedError):
+                # Socket buffer is full, give the loop a chance to drain it
+                await asyncio.sleep(0.001)
+            except OSError:
+                return False
+        return False
+
+    async def probe_batch(self, target_ips, on_reply=None):
+        # on_reply(ip, success, latency) is called for every target as soon as
+        # its reply arrives or it fails, not when the whole batch is done
+        replies = {}
+
+        def settle(target_ip, success, latency):
+            replies[target_ip] = (success, latency)
+            if on_reply:
+                on_reply(target_ip, success, latency)
+
+        def answered(target_ip, future):
+            if not future.cancelled():
+                settle(target_ip, True, round(future.result(), 3))
+
+        futures = {}
+        for target_ip in target_ips:
+            sequence = self.next_sequence()
+            future = self.loop.create_future()
+            self.pending[(target_ip, sequence)] = (future, time.monotonic_ns())
+            if await self.send(target_ip, self.build_packet(sequence)):
+                futures[target_ip] = (future, sequence)
+                future.add_done_callback(lambda done, target_ip=target_ip: answered(target_ip, done))
+            else:
+                del self.pending[(target_ip, sequence)]
+                settle(target_ip, False, None)
+        if futures:
+            await asyncio.wait([future for future, _ in futures.values()], timeout=self.timeout)
+        for target_ip, (future, sequence) in futures.items():
+            self.pending.pop((target_ip, sequence), None)
+            if not future.done():
+                future.cancel()
+                settle(target_ip, False, None)
+        # Give the callbacks of replies that made it in at the last moment a turn
+        await asyncio.sleep(0)
+        return replies
+
+    def probe_async(self, target_ips, on_reply=None):
+        # Returns a concurrent.futures.Future of ip -> (success, latency), see probe_batch()
+        return asyncio.run_coroutine_threadsafe(self.probe_batch(target_ips, on_reply), self.loop)
+
+    def probe(self, target_ips):
+        # Blocking entry point for the tester thread, returns ip -> (success, latency)
+        return self.probe_async(target_ips).result()
+
+class TTLTracer:
+    """Traces many targets at once by sending a UDP probe for every hop of
+    every target from one unprivileged socket. ICMP time exceeded and port
+    unreachable replies are read from the socket error queue (IP_RECVERR) and
+    matched to the probe by destination address and port. Output mimics
+    `traceroute -n -q 1` so it reads the same on the server."""
+
+    def __init__(self, max_hops=TRACE_MAX_HOPS, wait=TRACE_WAIT, attempts=TRACE_ATTEMPTS):
+        self.max_hops = max_hops
+        self.wait = wait
+        self.attempts = attempts
+        # Fail early if the kernel can't report ICMP errors on UDP sockets
+        self.open_socket().close()
+
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_IP, IP_RECVERR, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except OSError:
+            pass
+        sock.setblocking(False)
+        return sock
+
+    def probe_port(self, attempt, ttl):
+        return TRACE_BASE_PORT + attempt * self.max_hops + ttl
+
+    def complete(self, target_hops):
+        # Destination reached and every hop before it answered
+        reached = [ttl for ttl, hop in target_hops.items() if hop[2]]
+        return bool(reached) and all(ttl in target_hops for ttl in range(1, min(reached)))
+
+    def trace_many(self, target_ips):
+        sock = self.open_socket()
+        probes = {}  # (target_ip, port) -> (ttl, sent_ns)
+        hops = {target_ip: {} for target_ip in target_ips}  # ttl -> (hop_ip, rtt_ms, reached, flag)
+        try:
+            for attempt in range(self.attempts):
+                if all(self.complete(target_hops) for target_hops in hops.values()):
+                    break
+                # Hop-major order spreads the probes that hit the same router
+                # over the whole send burst, which keeps ICMP rate limits at bay
+                limits = {}
+                for target_ip in target_ips:
+                    reached = [ttl for ttl, hop in hops[target_ip].items() if hop[2]]
+                    limits[target_ip] = min(reached) if reached else self.max_hops
+                for ttl in range(1, self.max_hops + 1):
+                    sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+                    for target_ip in target_ips:
+                        if ttl > limits[target_ip] or ttl in hops[target_ip]:
+                            continue
+                        port = self.probe_port(attempt, ttl)
+                        try:
+                            sock.sendto(b'nodepathtest', (target_ip, port))
+                        except OSError:
+                            continue
+                        probes[(target_ip, port)] = (ttl, time.monotonic_ns())
+                self.collect(sock, probes, hops)
+        finally:
+            sock.close()
+        return {target_ip: self.format(target_ip, hops[target_ip]) for target_ip in target_ips}
+
+    def collect(self, sock, probes, hops):
+        poller = select.poll()
+        poller.register(sock, select.POLLERR | select.POLLIN)
+        deadline = time.monotonic() + self.wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or all(self.complete(target_hops) for target_hops in hops.values()):
+                return
+            if not poller.poll(remaining * 1000):
+                continue
+            while True:
+                try:
+                    _, ancdata, _, address = sock.recvmsg(512, 512, MSG_ERRQUEUE)
+                except (BlockingIOError, InterruptedError):
+                    break
+                received_ns = time.monotonic_ns()
+                probe = probes.pop((address[0], address[1]), None) if address else None
+                if probe is None:
+                    continue
+                for level, kind, data in ancdata:
+                    if level != socket.SOL_IP or kind != IP_RECVERR or len(data) < 24:
+                        continue
+                    _, origin, icmp_type, icmp_code, _, _, _ = struct.unpack('=IBBBBII', data[:16])
+                    if origin != SO_EE_ORIGIN_ICMP:
+                        continue
+                    hop_ip = socket.inet_ntoa(data[20:24])
+                    # Destination unreachable ends the trace; anything but port
+                    # unreachable from the target is flagged like traceroute does
+                    reached = icmp_type == 3
+                    flag = ''
+                    if reached and icmp_code != 3:
+                        flag = ' ' + UNREACH_FLAGS.get(icmp_code, f'!<{icmp_code}>')
+                    ttl, sent_ns = probe
+                    hops[address[0]][ttl] = (hop_ip, (received_ns - sent_ns) / 1e6, reached, flag)
+                # Drain anything that arrived on the normal queue
+                try:
+                    sock.recv(512)
+                except OSError:
+                    pass
+
+    def format(self, target_ip, target_hops):
+        reached = [ttl for ttl, hop in target_hops.items() if hop[2]]
+        last_ttl = min(reached) if reached else self.max_hops
+        lines = [f"traceroute to {target_ip} ({target_ip}), {self.max_hops} hops max, 60 byte packets"]
+        for ttl in range(1, last_ttl + 1):
+            if ttl in target_hops:
+                hop_ip, rtt, _, flag = target_hops[ttl]
+                lines.append(f"{ttl:2d}  {hop_ip}  {rtt:.3f} ms{flag}")
+            else:
+                lines.append(f"{ttl:2d}  *")
+        return '\n'.join(lines) + '\n'
+
+class TracerouteQueue:
+    """Runs traceroutes in the background with bounded concurrency so probing
+    never waits on them. A target already queued or running for the same kind
+    isn't traced again; finished outputs are collected with drain() and sent
+    along with the next report."""
+
+    def __init__(self, traceroute, workers=TRACEROUTE_WORKERS):
+        self.traceroute = traceroute
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='traceroute')
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.in_flight = set()  # (kind, target_hostname)
+        self.completed = {}  # kind -> {target_hostname: output}
+        self.elapsed = 0.0  # Seconds spent on traceroutes finished since take_elapsed()
+
+    def submit(self, kind, target_hostname, target_ip):
+        with self.lock:
+            if (kind, target_hostname) in self.in_flight:
+                return False
+            self.in_flight.add((kind, target_hostname))
+            generation = self.generation
+        self.pool.submit(self.run, generation, kind, target_hostname, target_ip)
+        return True
+
+    def run(self, generation, kind, target_hostname, target_ip):
+        started = time.monotonic()
+        try:
+            output = self.traceroute(target_ip)
+        except Exception as e:
+            output = f"traceroute failed: {e}"
+        with self.lock:
+            if generation != self.generation:
+                # Started before a reset, belongs to a previous test run
+                return
+            self.in_flight.discard((kind, target_hostname))
+            self.completed.setdefault(kind, {})[target_hostname] = output
+            self.elapsed += time.monotonic() - started
+
+    def drain(self):
+        with self.lock:
+            completed, self.completed = self.completed, {}
+        return completed
+
+    def take_elapsed(self):
+        with self.lock:
+            elapsed, self.elapsed = self.elapsed, 0.0
+        return elapsed
+
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.in_flight = set()
+            self.completed = {}
+            self.elapsed = 0.0
+
+class ProbeScheduler:
+    """Fires each target's probe on a fixed schedule from its own thread, so
+    the probe rate neither drifts with the roster size, the slowest reply or
+    server latency, nor stalls during roster fetches and uploads. Targets get
+    evenly spread slots within the interval to avoid bursts; a target that
+    fell behind skips the slots it missed instead of catching up. Unless
+    overlap is set, so does a target whose previous probe hasn't come back
+    yet, for probes that each hold a thread. set_rate() probes a target at a
+    multiple of the interval instead. Finished results are collected with
+    drain()."""
+
+    def __init__(self, probe_async, interval=PROBE_INTERVAL, jitter=PROBE_JITTER, window=PROBE_BATCH_WINDOW,
+                 overlap=False):
+        self.probe_async = probe_async  # (target_ips, on_reply) -> Future of the finished batch
+        self.interval = interval
+        self.jitter = jitter
+        self.window = window
+        self.overlap = overlap
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.targets = {}  # target_hostname -> target_ip
+        self.heap = []  # (fire time, slot time, target_hostname)
+        self.anchor = time.monotonic()
+        self.last_fired = {}  # target_hostname -> monotonic time of its last probe
+        self.rates = {}  # target_hostname -> multiple of the interval it is probed at, when not 1
+        self.in_flight = set()  # Targets whose probe hasn't come back yet
+        self.completed = []  # (target_hostname, target_ip, timestamp, success, latency)
+        self.elapsed = 0.0  # Seconds spent in probe batches finished since take_elapsed()
+        threading.Thread(target=self.run, name='probe-scheduler', daemon=True).start()
+
+    def step(self, target_hostname):
+        return self.interval * self.rates.get(target_hostname, 1)
+
+    def next_slot(self, slot, not_before, step):
+        # First occurrence of a slot at or after not_before
+        if slot < not_before:
+            slot += math.ceil((not_before - slot) / step) * step
+        return slot
+
+    def schedule(self, slot, target_hostname):
+        fire = slot + random.uniform(-self.jitter, self.jitter) * self.interval
+        heapq.heappush(self.heap, (fire, slot, target_hostname))
+
+    def set_targets(self, targets):
+        with self.condition:
+            if targets == self.targets:
+                return
+            # Re-spread every target over the interval, without probing any
+            # target again sooner than half an interval after its last probe
+            now = time.monotonic()
+            self.targets = dict(targets)
+            self.heap = []
+            hostnames = sorted(targets)
+            self.rates = {target_hostname: rate for target_hostname, rate in self.rates.items()
+                          if target_hostname in targets}
+            for index, target_hostname in enumerate(hostnames):
+                slot = self.anchor + index * self.interval / len(hostnames)
+                step = self.step(target_hostname)
+                last = self.last_fired.get(target_hostname)
+                not_before = now if last is None else max(now, last + step / 2)
+                self.schedule(self.next_slot(slot, not_before, step), target_hostname)
+            self.last_fired = {target_hostname: fired for target_hostname, fired in self.last_fired.items()
+                               if target_hostname in targets}
+            self.condition.notify()
+
+    def rate(self, target_hostname):
+        with self.condition:
+            return self.rates.get(target_hostname, 1)
+
+    def set_rate(self, target_hostname, rate):
+        # Probe a target every rate intervals from now on. Slowing down takes
+        # effect after the probe already scheduled, speeding up right away.
+        with self.condition:
+            previous = self.rates.get(target_hostname, 1)
+            if rate == previous or target_hostname not in self.targets:
+                return
+            if rate == 1:
+                del self.rates[target_hostname]
+            else:
+                self.rates[target_hostname] = rate
+            if rate > previous:
+                return
+            self.heap = [entry for entry in self.heap if entry[2] != target_hostname]
+            heapq.heapify(self.heap)
+            now = time.monotonic()
+            last = self.last_fired.get(target_hostname)
+            self.schedule(now if last is None else max(now, last + self.step(target_hostname)), target_hostname)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                if self.heap[0][0] > now:
+                    self.condition.wait(self.heap[0][0] - now)
+                    continue
+                batch = {}
+                while self.heap and self.heap[0][0] <= now + self.window:
+                    _, slot, target_hostname = heapq.heappop(self.heap)
+                    step = self.step(target_hostname)
+                    self.schedule(self.next_slot(slot + step, now, step), target_hostname)
+                    if target_hostname in self.in_flight:
+                        continue
+                    batch[target_hostname] = self.targets[target_hostname]
+                    self.last_fired[target_hostname] = now
+                    if not self.overlap:
+                        self.in_flight.add(target_hostname)
+                if not batch:
+                    continue
+                generation = self.generation
+            self.launch(generation, batch)
+
+    def launch(self, generation, batch):
+        started = time.monotonic()
+        timestamp = int(time.time())
+        hostnames = {}  # target_ip -> target hostnames sharing it
+        for target_hostname, target_ip in batch.items():
+            hostnames.setdefault(target_ip, []).append(target_hostname)
+        try:
+            future = self.probe_async(sorted(hostnames),
+                                      lambda target_ip, success, latency: self.collect(
+                                          generation, hostnames[target_ip], target_ip, timestamp, success, latency))
+        except Exception as e:
+            logging.error(f"Error starting probes: {e}")
+            self.finish(generation, batch, started, None)
+            return
+        future.add_done_callback(lambda done: self.finish(generation, batch, started, done))
+
+    def collect(self, generation, target_hostnames, target_ip, timestamp, success, latency):
+        with self.condition:
+            if generation != self.generation:
+                # Probed before a reset, belongs to a previous test run
+                return
+            self.in_flight.difference_update(target_hostnames)
+            for target_hostname in target_hostnames:
+                self.completed.append((target_hostname, target_ip, timestamp, success, latency))
+
+    def finish(self, generation, batch, started, future):
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Error probing targets: {e}")
+        with self.condition:
+            if generation != self.generation:
+                return
+            # Targets the batch failed before reporting may be probed again
+            self.in_flight.difference_update(batch)
+            if future is not None:
+                self.elapsed += time.monotonic() - started
+
+    def drain(self):
+        with self.condition:
+            completed, self.completed = self.completed, []
+        return completed
+
+    def take_elapsed(self):
+        with self.condition:
+            elapsed, self.elapsed = self.elapsed, 0.0
+        return elapsed
+
+    def reset(self):
+        # Stop probing and forget results of the current test run
+        with self.condition:
+            self.generation += 1
+            self.targets = {}
+            self.heap = []
+            self.last_fired = {}
+            self.rates = {}
+            self.in_flight = set()
+            self.completed = []
+            self.elapsed = 0.0
+
+class WindowAggregator:
+    """Folds probe results into one summary per target and window, with
+    windows aligned to multiples of the window length. Jitter is the mean
+    absolute difference between consecutive latencies."""
+
+    def __init__(self, window=AGGREGATE_WINDOW):
+        self.window = window
+        self.windows = {}  # (target_hostname, window_start) -> running summary
+
+    def add(self, target_hostname, target_ip, timestamp, success, latency):
+        window_start = int(timestamp // self.window * self.window)
+        summary = self.windows.get((target_hostname, window_start))
+        if summary is None:
+            summary = self.windows[(target_hostname, window_start)] = {
+                'destination_ip': target_ip, 'sent': 0, 'lost': 0, 'min': None, 'max': None,
+                'total': 0.0, 'received': 0, 'jitter_total': 0.0, 'jitter_count': 0,
+                'last_latency': None, 'histogram': {}, 'failures': []}
+        summary['sent'] += 1
+        if not success:
+            summary['lost'] += 1
+            summary['failures'].append(timestamp)
+        elif latency is not None:
+            summary['min'] = latency if summary['min'] is None else min(summary['min'], latency)
+            summary['max'] = latency if summary['max'] is None else max(summary['max'], latency)
+            summary['total'] += latency
+            summary['received'] += 1
+            if summary['last_latency'] is not None:
+                summary['jitter_total'] += abs(latency - summary['last_latency'])
+                summary['jitter_count'] += 1
+            summary['last_latency'] = latency
+            key = math.ceil(math.log(max(latency, SKETCH_MIN_LATENCY)) / SKETCH_LOG_GAMMA)
+            summary['histogram'][key] = summary['histogram'].get(key, 0) + 1
+
+    def take(self, now=None):
+        # Summaries of the windows that closed (all of them when now is None),
+        # as target_hostname -> [aggregate, ...] in window order
+        closed = {}
+        for (target_hostname, window_start), summary in sorted(self.windows.items()):
+            if now is not None and window_start + self.window + AGGREGATE_GRACE > now:
+                continue
+            del self.windows[(target_hostname, window_start)]
+            closed.setdefault(target_hostname, []).append({
+                'window_start': window_start,
+                'window': self.window,
+                'destination_ip': summary['destination_ip'],
+                'sent': summary['sent'],
+                'lost': summary['lost'],
+                'min': summary['min'],
+                'avg': round(summary['total'] / summary['received'], 3) if summary['received'] else None,
+                'max': summary['max'],
+                'jitter': round(summary['jitter_total'] / summary['jitter_count'], 3) if summary['jitter_count'] else None,
+                # Pairs rather than a dict, so the buckets survive the JSON spill file
+                'histogram': sorted(summary['histogram'].items()),
+                'failures': summary['failures']
+            })
+        return closed
+
+    def clear(self):
+        self.windows = {}
+
+class ResultBuffer:
+    """Bounded FIFO of result rounds waiting for upload. Holds up to
+    memory_rounds in memory; further rounds are appended to a spill file and
+    read back in order once the memory part has drained. A batch handed out by
+    take() is handed out again, under the same batch id, until it is acked, so
+    the server can recognise a retry of a batch it already applied."""
+
+    def __init__(self, memory_rounds=BUFFER_MEMORY_ROUNDS, spill_path=BUFFER_SPILL_PATH,
+                 spill_max_bytes=BUFFER_SPILL_MAX_BYTES):
+        self.lock = threading.Lock()
+        self.memory = deque()
+        self.memory_rounds = memory_rounds
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self.spilled = 0
+        self.dropped = 0
+        self.run = os.urandom(4).hex()  # Keeps batch ids unique across client restarts
+        self.sequence = 0
+        self.unacked = None  # (batch id, rounds) taken but not acked yet
+        # Rounds a previous run of the client couldn't deliver
+        if os.path.exists(spill_path):
+            with open(spill_path, 'r') as f:
+                self.spilled = sum(1 for _ in f)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.memory) + self.spilled + (len(self.unacked[1]) if self.unacked else 0)
+
+    def add(self, round_data):
+        with self.lock:
+            # Once spilling, keep appending to the file so rounds stay in order
+            if not self.spilled and len(self.memory) < self.memory_rounds:
+                self.memory.append(round_data)
+                return
+            try:
+                if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) >= self.spill_max_bytes:
+                    self.dropped += 1
+                    logging.error(f"Result buffer full, dropped {self.dropped} rounds")
+                    return
+                with open(self.spill_path, 'a') as f:
+                    f.write(json.dumps(round_data) + '\n')
+                self.spilled += 1
+            except OSError as e:
+                self.dropped += 1
+                logging.error(f"Error spilling results to {self.spill_path}: {e}")
+
+    def load_spilled(self):
+        # Move the oldest spilled rounds back into memory, keep the rest on disk
+        try:
+            with open(self.spill_path, 'r') as f:
+                lines = f.readlines()
+        except OSError as e:
+            logging.error(f"Error reading spilled results from {self.spill_path}: {e}")
+            self.spilled = 0
+            return
+        for line in lines[:self.memory_rounds]:
+            try:
+                self.memory.append(json.loads(line))
+            except ValueError:
+                continue
+        remaining = lines[self.memory_rounds:]
+        with open(self.spill_path, 'w') as f:
+            f.writelines(remaining)
+        self.spilled = len(remaining)
+        if not remaining:
+            os.remove(self.spill_path)
+
+    def take(self, limit):
+        # Returns (batch id, rounds), rounds empty when there is nothing to send
+        with self.lock:
+            if self.unacked is None:
+                if not self.memory and self.spilled:
+                    self.load_spilled()
+                batch = []
+                while self.memory and len(batch) < limit:
+                    batch.append(self.memory.popleft())
+                if not batch:
+                    return None, []
+                self.sequence += 1
+                self.unacked = (f"{self.run}-{self.sequence}", batch)
+            return self.unacked
+
+    def ack(self, batch_id):
+        # The server has the batch, drop it
+        with self.lock:
+            if self.unacked is not None and self.unacked[0] == batch_id:
+                self.unacked = None
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.unacked = None
+            self.spilled = 0
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+
+def run_udp_echo_responder():
+    # Answers the UDP echo probes of clients that can't open ICMP sockets
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', UDP_ECHO_PORT))
+    while True:
+        try:
+            data, address = sock.recvfrom(2048)
+            if data[:4] == UDP_ECHO_MAGIC:
+                sock.sendto(data, address)
+        except OSError as e:
+            logging.error(f"UDP echo responder error: {e}")
+            time.sleep(1)
 
 class NetworkTester:
     def __init__(self):
         self.hostname = self.get_hostname()
         self.ip_address = self.get_ip_address()
-        self.initial_traceroutes_sent = False
+        self.initial_traced = set()  # Targets an initial traceroute was run for
         self.running_tests = False
         self.server_available = True
         self.session = requests.Session()
         # Dictionaries to keep track of state per target
         self.previous_state = {}  # Stores the previous ping result ('Success' or 'Fail') for each target
         self.traceroute_run = {}  # Indicates whether a traceroute has been run after the last state change for each target
+        # Adaptive probing state per target, see ADAPTIVE_PROBING
+        self.latency_average = {}  # Running average latency of successful probes
+        self.clean_results = {}  # Clean results since the last rate change
+        self.burst_left = {}  # Probes left in the current burst
+        # Long-lived probe workers shared by every round, and fping if installed
+        # so a whole round can be probed with a single process
+        self.probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix='probe')
+        self.fping_path = shutil.which('fping')
+        self.tracer = None
+        if TRACEROUTE_METHOD != 'traceroute':
+            try:
+                self.tracer = TTLTracer()
+            except OSError as e:
+                logging.error(f"In-process tracer unavailable, falling back to traceroute: {e}")
+        self.traceroute_queue = TracerouteQueue(self.traceroute)
+        # Rounds waiting to be shipped by upload_loop on its own session
+        self.buffer = ResultBuffer()
+        self.upload_session = requests.Session()
+        self.flush_event = threading.Event()
+        self.clients = None  # Local copy of the server's client roster
+        self.roster_version = None  # Roster version self.clients is at
+        self.server_roster_version = None  # Roster version announced with the last command poll
+        # Peers the server asks us to probe this sampling epoch, None for the full mesh
+        self.sampled_targets = None
+        self.targets_expire = 0.0  # Monotonic time the sample is due for a refresh
+        self.targets_roster_version = None  # Roster version the sample was taken at
+        self.round_timings = {}  # Seconds per phase of the last round
+        self.last_upload_time = None  # Seconds the last upload took
+        self.prober = None
+        if PROBE_METHOD != 'ping':
+            try:
+                self.prober = AsyncProber(PROBE_METHOD)
+            except OSError as e:
+                logging.error(f"In-process prober unavailable, falling back to ping: {e}")
+        # Forked probes block a thread per batch, so batch them more coarsely
+        self.batch_pool = ThreadPoolExecutor(max_workers=PROBE_BATCH_WORKERS, thread_name_prefix='probe-batch')
+        # In-process probes are matched to replies by sequence number, so a target
+        # in a burst may have several of them out at once
+        self.scheduler = ProbeScheduler(self.probe_async,
+                                        window=PROBE_BATCH_WINDOW if self.prober else PROBE_SUBPROCESS_WINDOW,
+                                        overlap=bool(self.prober))
+        self.aggregator = WindowAggregator(AGGREGATE_WINDOW) if AGGREGATE_WINDOW > 0 else None
         # Configure logging
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s [%(levelname)s] %(message)s')
@@ -51,11 +856,14 @@ class NetworkTester:
                 logging.error(f"Error registering with server: {e}")
                 time.sleep(5)
     
-    def get_commands(self):
+    def get_commands(self, wait=0):
         url = SERVER_URL + '/get_commands'
         params = {'hostname': self.hostname}
+        if wait:
+            # Long-poll: the server answers as soon as a command is queued
+            params['wait'] = wait
         try:
-            response = self.session.get(url, params=params, timeout=5)
+            response = self.session.get(url, params=params, timeout=wait + 5)
             if response.status_code == 200:
                 return response.json()
         except Exception as e:
@@ -63,190 +871,430 @@ class NetworkTester:
         return None
     
     def get_clients(self):
+        # Nothing to fetch while the server announces the version we hold
+        if self.roster_version is not None and self.roster_version == self.server_roster_version:
+            return self.clients
         url = SERVER_URL + '/get_clients'
+        params = {'since': self.roster_version} if self.roster_version is not None else {}
         try:
-            response = self.session.get(url, timeout=5)
+            response = self.session.get(url, params=params, timeout=5)
             if response.status_code == 200:
-                return response.json().get('clients')
+                data = response.json()
+                if 'changes' in data:
+                    clients = dict(self.clients)
+                    for target_hostname, info in data['changes'].items():
+                        if info is None:
+                            clients.pop(target_hostname, None)
+                        else:
+                            clients[target_hostname] = info
+                    self.clients = clients
+                else:
+                    self.clients = data.get('clients')
+                self.roster_version = data.get('version')
+                return self.clients
         except Exception as e:
             logging.error(f"Error getting clients: {e}")
-        return None
+        # Keep testing against the last known roster through a server hiccup
+        return self.clients
     
+    def get_targets(self):
+        # The peers to probe this sampling epoch, None for the full mesh. Asked
+        # again when the epoch ends or the roster changed.
+        if time.monotonic() < self.targets_expire and self.targets_roster_version == self.roster_version:
+            return self.sampled_targets
+        url = SERVER_URL + '/get_targets'
+        try:
+            response = self.session.get(url, params={'hostname': self.hostname}, timeout=5)
+            if response.status_code == 200:
+                data = response.json()
+                targets = data.get('targets')
+                self.sampled_targets = set(targets) if targets is not None else None
+                refresh = data.get('expires_in', SAMPLE_REFRESH)
+            else:
+                # Server without sampling, probe the full mesh
+                self.sampled_targets = None
+                refresh = SAMPLE_REFRESH
+            self.targets_expire = time.monotonic() + refresh
+            self.targets_roster_version = self.roster_version
+        except Exception as e:
+            logging.error(f"Error getting targets: {e}")
+        return self.sampled_targets
+
     def ping_host(self, target_ip):
         result = subprocess.run(['ping', '-c', '1', '-W', '0.8', target_ip],
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output = result.stdout.decode()
-        match = re.search(r'time=(\d+\.\d+)', output)
+        match = re.search(r'time=(\d+(?:\.\d+)?)', output)
         latency = float(match.group(1)) if match else None
         return result.returncode == 0, latency
     
-    def traceroute(self, target_ip):
+    def fping_hosts(self, target_ips):
+        result = subprocess.run([self.fping_path, '-C', '1', '-q', '-t', '800', '-r', '0'] + target_ips,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # fping -C reports one "<ip> : <ms>" line per host on stderr, "-" when lost
+        replies = {}
+        for line in result.stderr.decode().splitlines():
+            match = re.match(r'(\S+)\s+:\s+(\S+)', line)
+            if match:
+                target_ip, value = match.groups()
+                replies[target_ip] = (False, None) if value == '-' else (True, float(value))
+        return replies
+
+    def probe_ips(self, target_ips, on_reply=None):
+        # Blocking probe of a batch with fping or ping, returns ip -> (success, latency)
+        if self.fping_path:
+            replies = self.fping_hosts(target_ips)
+            replies = {target_ip: replies.get(target_ip, (False, None)) for target_ip in target_ips}
+        else:
+            replies = dict(zip(target_ips, self.probe_pool.map(self.ping_host, target_ips)))
+        if on_reply:
+            for target_ip, (success, latency) in replies.items():
+                on_reply(target_ip, success, latency)
+        return replies
+
+    def probe_async(self, target_ips, on_reply=None):
+        # Probe a batch without waiting for it, returns a Future of ip -> (success, latency).
+        # on_reply(ip, success, latency) hears about every target as its result is in.
+        if self.prober:
+            return self.prober.probe_async(target_ips, on_reply)
+        return self.batch_pool.submit(self.probe_ips, target_ips, on_reply)
+
+    def traceroute_command(self, target_ip):
         result = subprocess.run(['traceroute', '-n', '-w', '1', '-q', '1', target_ip],
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return result.stdout.decode()
+
+    def traceroute(self, target_ip):
+        if self.tracer:
+            return self.tracer.trace_many([target_ip])[target_ip]
+        return self.traceroute_command(target_ip)
+
+    def traceroute_sweep(self, targets):
+        # Trace every target concurrently, returns hostname -> output
+        target_ips = sorted(set(targets.values()))
+        if self.tracer:
+            outputs = self.tracer.trace_many(target_ips)
+        else:
+            with ThreadPoolExecutor(max_workers=TRACEROUTE_PARALLELISM, thread_name_prefix='sweep') as pool:
+                outputs = dict(zip(target_ips, pool.map(self.traceroute_command, target_ips)))
+        return {target_hostname: outputs[target_ip] for target_hostname, target_ip in targets.items()}
     
     def perform_tests(self, clients):
-        source_ip = self.ip_address
-        results = {}
-        threads = []
-        thread_results = {}
-        traceroutes = {}
+        # Keep the scheduler's targets in line with the roster and collect what it
+        # probed since the last call. Returns the results split into rounds with at
+        # most one result per target each, the aggregates of the windows that
+        # closed, and the traceroutes to report.
         initial_traceroutes = {}
 
-        data_lock = threading.Lock()
+        sampled = self.get_targets()
+        targets = {target_hostname: info['ip_address'] for target_hostname, info in clients.items()
+                   if target_hostname != self.hostname and (sampled is None or target_hostname in sampled)}
+        self.scheduler.set_targets(targets)
 
-        def ping_target(target_hostname, target_ip):
-            success, latency = self.ping_host(target_ip)
-            result = 'Success' if success else 'Fail'
+        timings = {'traceroute': 0.0}
 
-            with data_lock:
-                thread_results[target_hostname] = {
-                    'result': result,
-                    'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'latency': latency,
-                    'source_ip': source_ip,
-                    'destination_ip': target_ip
-                }
-
-                # Initialize previous_state and traceroute_run if not already set
-                if target_hostname not in self.previous_state:
-                    self.previous_state[target_hostname] = result
-                    self.traceroute_run[target_hostname] = False
-                else:
-                    if result != self.previous_state[target_hostname]:
-                        # State has changed
-                        if not self.traceroute_run[target_hostname]:
-                            # Run additional traceroute
-                            trace_output = self.traceroute(target_ip)
-                            if 'additional' not in traceroutes:
-                                traceroutes['additional'] = {}
-                            traceroutes['additional'][target_hostname] = trace_output
-                            # Set traceroute_run to True
-                            self.traceroute_run[target_hostname] = True
-                        # Update previous state
-                        self.previous_state[target_hostname] = result
-                    else:
-                        # State hasn't changed
-                        # Reset traceroute_run to False to allow traceroute on next state change
-                        self.traceroute_run[target_hostname] = False
-
-        # Perform initial traceroutes once
-        if not self.initial_traceroutes_sent:
-            initial_traceroutes = {}
-            for target_hostname, info in clients.items():
-                if target_hostname == self.hostname:
-                    continue
-                target_ip = info['ip_address']
-                trace_output = self.traceroute(target_ip)
-                initial_traceroutes[target_hostname] = trace_output
-            self.initial_traceroutes_sent = True
-
-        # Start ping tests
-        for target_hostname, info in clients.items():
-            if target_hostname == self.hostname:
+        # Perform initial traceroutes once per target: all of the first round's in
+        # one sweep, targets that show up later (new nodes, the next sampling
+        # epoch's peers) in the background
+        if not self.initial_traced:
+            started = time.monotonic()
+            initial_traceroutes = self.traceroute_sweep(targets)
+            timings['traceroute'] = time.monotonic() - started
+            self.initial_traced.update(targets)
+        else:
+            for target_hostname, target_ip in targets.items():
+                if target_hostname not in self.initial_traced:
+                    self.traceroute_queue.submit('initial', target_hostname, target_ip)
+                    self.initial_traced.add(target_hostname)
+
+        result_rounds, aggregates = self.collect_results()
+
+        # Attach the background traceroutes that finished since the last round
+        traceroutes = self.traceroute_queue.drain()
+        timings['traceroute'] += self.traceroute_queue.take_elapsed()
+        timings['probe'] = self.scheduler.take_elapsed()
+        self.round_timings = timings
+        return result_rounds, aggregates, initial_traceroutes, traceroutes
+
+    def collect_results(self, flush=False):
+        # Take the scheduler's results, either as rounds of individual results or
+        # folded into window aggregates. flush also hands over the windows still open.
+        result_rounds = [{}]
+        for target_hostname, target_ip, timestamp, success, latency in self.scheduler.drain():
+            result = 'Success' if success else 'Fail'
+            self.track_state(target_hostname, target_ip, result, latency)
+            if self.aggregator:
+                self.aggregator.add(target_hostname, target_ip, timestamp, success, latency)
                 continue
-            target_ip = info['ip_address']
-            t = threading.Thread(target=ping_target, args=(target_hostname, target_ip))
-            threads.append(t)
-            t.start()
-
-        # Wait for all threads to complete
-        for t in threads:
-            t.join()
-
-        # Collect results
-        results.update(thread_results)
-        return results, initial_traceroutes, traceroutes
+            if target_hostname in result_rounds[-1]:
+                result_rounds.append({})
+            result_rounds[-1][target_hostname] = {
+                'result': result,
+                'timestamp': timestamp,
+                'latency': latency,
+                'source_ip': self.ip_address,
+                'destination_ip': target_ip
+            }
+        aggregates = {}
+        if self.aggregator:
+            aggregates = self.aggregator.take(None if flush else time.time())
+        return result_rounds, aggregates
+
+    def track_state(self, target_hostname, target_ip, result, latency=None):
+        if ADAPTIVE_PROBING:
+            self.adapt_rate(target_hostname, self.previous_state.get(target_hostname), result, latency)
+        # Initialize previous_state and traceroute_run if not already set
+        if target_hostname not in self.previous_state:
+            self.previous_state[target_hostname] = result
+            self.traceroute_run[target_hostname] = False
+        else:
+            if result != self.previous_state[target_hostname]:
+                # State has changed
+                if not self.traceroute_run[target_hostname]:
+                    # Queue additional traceroute, it is reported with a later round
+                    self.traceroute_queue.submit('additional', target_hostname, target_ip)
+                    # Set traceroute_run to True
+                    self.traceroute_run[target_hostname] = True
+                # Update previous state
+                self.previous_state[target_hostname] = result
+            else:
+                # State hasn't changed
+                # Reset traceroute_run to False to allow traceroute on next state change
+                self.traceroute_run[target_hostname] = False
+
+    def adapt_rate(self, target_hostname, previous, result, latency):
+        # Burst on a new failure or a latency jump, otherwise back off while the
+        # target stays clean
+        average = self.latency_average.get(target_hostname)
+        jump = (result == 'Success' and latency is not None and average is not None
+                and latency > average * PROBE_JUMP_FACTOR and latency - average >= PROBE_JUMP_MIN)
+        if result == 'Success' and latency is not None:
+            self.latency_average[target_hostname] = latency if average is None else average + (latency - average) / 10
+        rate = self.scheduler.rate(target_hostname)
+        if jump or (result == 'Fail' and (previous == 'Success' or rate > 1)):
+            self.burst_left[target_hostname] = PROBE_BURST_COUNT
+            self.clean_results[target_hostname] = 0
+            self.scheduler.set_rate(target_hostname, PROBE_BURST_FACTOR)
+        elif self.burst_left.get(target_hostname):
+            self.burst_left[target_hostname] -= 1
+            if not self.burst_left[target_hostname]:
+                self.scheduler.set_rate(target_hostname, 1)
+        elif result == 'Fail':
+            self.clean_results[target_hostname] = 0
+        else:
+            self.clean_results[target_hostname] = self.clean_results.get(target_hostname, 0) + 1
+            if self.clean_results[target_hostname] >= PROBE_BACKOFF_AFTER and rate < PROBE_BACKOFF_MAX:
+                self.clean_results[target_hostname] = 0
+                self.scheduler.set_rate(target_hostname, min(rate * 2, PROBE_BACKOFF_MAX))
     
-    def report_results(self, results, initial_traceroutes, traceroutes):
-        url = SERVER_URL + '/report_results'
+    def report_results(self, results, initial_traceroutes, traceroutes, timings=None, aggregates=None):
+        # Queue the round, upload_loop ships it with the next batch
         data = {
-            'hostname': self.hostname,
+            'timestamp': int(time.time()),
             'results': results,
             'traceroutes': {}
         }
+        if aggregates:
+            data['aggregates'] = aggregates
+        if timings:
+            data['timings'] = timings
         # Send initial traceroutes only once
         if initial_traceroutes:
             data['traceroutes']['initial'] = initial_traceroutes
         if traceroutes:
             # Merge traceroutes into data['traceroutes']
-            data['traceroutes'].update(traceroutes)
+            for kind, outputs in traceroutes.items():
+                data['traceroutes'].setdefault(kind, {}).update(outputs)
+        self.buffer.add(data)
+        return True
+
+    def encode_rounds(self, rounds, batch_id=None):
+        # Compact /ingest batch: a header naming every target once, then one
+        # JSON array per result or traceroute referring to targets by index
+        target_index = {}
+        lines = []
+
+        def index_of(target_hostname, target_ip):
+            key = (target_hostname, target_ip)
+            if key not in target_index:
+                target_index[key] = len(target_index)
+            return target_index[key]
+
+        for round_data in rounds:
+            for target_hostname, result_info in round_data['results'].items():
+                index = index_of(target_hostname, result_info['destination_ip'])
+                lines.append([RECORD_RESULT, index, result_info['timestamp'],
+                              1 if result_info['result'] == 'Success' else 0, result_info['latency']])
+            for target_hostname, windows in round_data.get('aggregates', {}).items():
+                for aggregate in windows:
+                    index = index_of(target_hostname, aggregate['destination_ip'])
+                    lines.append([RECORD_AGGREGATE, index, aggregate['window_start'], aggregate['window'],
+                                  aggregate['sent'], aggregate['lost'], aggregate['min'], aggregate['avg'],
+                                  aggregate['max'], aggregate['jitter'], aggregate['histogram'],
+                                  aggregate['failures']])
+            for kind, outputs in round_data['traceroutes'].items():
+                for target_hostname, trace_output in outputs.items():
+                    target_ip = (self.clients or {}).get(target_hostname, {}).get('ip_address')
+                    index = index_of(target_hostname, target_ip)
+                    lines.append([RECORD_TRACEROUTE, index, kind, round_data['timestamp'], trace_output])
+        header = {'hostname': self.hostname, 'source_ip': self.ip_address,
+                  'targets': [list(key) for key in target_index]}
+        if batch_id is not None:
+            header['batch'] = batch_id
+        if self.aggregator:
+            header['sketch_accuracy'] = SKETCH_RELATIVE_ACCURACY
+        # Phase timings averaged over the batch, so the server can spot slow nodes
+        timings = {}
+        round_timings = [round_data['timings'] for round_data in rounds if round_data.get('timings')]
+        for phase in ('roster', 'probe', 'traceroute'):
+            values = [phases[phase] for phases in round_timings if phase in phases]
+            if values:
+                timings[phase] = round(sum(values) / len(values), 4)
+        if self.last_upload_time is not None:
+            timings['upload'] = round(self.last_upload_time, 4)
+        if timings:
+            header['timings'] = timings
+        return '\n'.join(json.dumps(line, separators=(',', ':')) for line in [header] + lines) + '\n'
+
+    def upload_rounds(self, rounds, batch_id=None):
+        url = SERVER_URL + '/ingest'
+        body = gzip.compress(self.encode_rounds(rounds, batch_id).encode())
+        headers = {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+        started = time.monotonic()
         try:
-            response = self.session.post(url, json=data, timeout=5)
+            response = self.upload_session.post(url, data=body, headers=headers, timeout=10)
+            self.last_upload_time = time.monotonic() - started
             if response.status_code == 200:
                 return True
+            if 400 <= response.status_code < 500:
+                # Retrying won't make the server accept it
+                logging.error(f"Server rejected {len(rounds)} rounds: {response.status_code}")
+                return True
         except Exception as e:
             logging.error(f"Error reporting results: {e}")
         return False
-    
+
+    def upload_loop(self):
+        # Ship buffered rounds in batches, backing off while the server is unreachable
+        delay = UPLOAD_INTERVAL
+        while True:
+            self.flush_event.wait(delay)
+            self.flush_event.clear()
+            while True:
+                batch_id, rounds = self.buffer.take(UPLOAD_BATCH_ROUNDS)
+                if not rounds:
+                    delay = UPLOAD_INTERVAL
+                    break
+                if not self.upload_rounds(rounds, batch_id):
+                    # The same batch goes again, the server skips it if it got there after all
+                    delay = min(delay * 2, UPLOAD_BACKOFF_MAX)
+                    logging.error(f"{len(self.buffer)} rounds buffered, retrying upload in {delay}s")
+                    break
+                self.buffer.ack(batch_id)
+
     def main_loop(self):
+        threading.Thread(target=run_udp_echo_responder, name='udp-echo', daemon=True).start()
+        threading.Thread(target=self.upload_loop, name='uploader', daemon=True).start()
         self.register()
         while True:
             if self.server_available:
                 try:
-                    command_data = self.get_commands()
+                    poll_started = time.monotonic()
+                    # Only long-poll while idle so test rounds keep their cadence
+                    command_data = self.get_commands(wait=0 if self.running_tests else COMMAND_WAIT)
                     if command_data:
                         command = command_data.get('command')
+                        self.server_roster_version = command_data.get('roster_version')
                     else:
                         command = None
                     if command == 'start_tests':
                         if not self.running_tests:
                             logging.info('Testing started...')
                             self.running_tests = True
-                            self.initial_traceroutes_sent = False
+                            self.initial_traced = set()
+                            self.targets_expire = 0.0
                             # Reset state tracking dictionaries
                             self.previous_state = {}
                             self.traceroute_run = {}
+                            self.latency_average = {}
+                            self.clean_results = {}
+                            self.burst_left = {}
+                            self.traceroute_queue.reset()
+                            self.scheduler.reset()
+                            if self.aggregator:
+                                self.aggregator.clear()
+                            # Rounds of a previous test must not leak into this one
+                            self.buffer.clear()
                     elif command == 'stop_tests':
                         if self.running_tests:
                             logging.info('Testing stopped.')
                             self.running_tests = False
+                            # Report what was probed since the last round, open windows included
+                            result_rounds, aggregates = self.collect_results(flush=True)
+                            for results in result_rounds:
+                                if results or aggregates:
+                                    self.report_results(results, {}, {}, aggregates=aggregates)
+                                    aggregates = None
+                            self.scheduler.reset()
                             # Run another traceroute to include at the end of the ping test in detailed reports
                             clients = self.get_clients()
                             if clients is not None and len(clients) > 1:
                                 # Run traceroutes to all clients
-                                final_traceroutes = {}
-                                for target_hostname, info in clients.items():
-                                    if target_hostname == self.hostname:
-                                        continue
-                                    target_ip = info['ip_address']
-                                    trace_output = self.traceroute(target_ip)
-                                    final_traceroutes[target_hostname] = trace_output
-                                # Report the final traceroutes
-                                self.report_results({}, {}, {'final': final_traceroutes})
+                                final_traceroutes = self.traceroute_sweep(
+                                    {target_hostname: info['ip_address'] for target_hostname, info in clients.items()
+                                     if target_hostname != self.hostname})
+                                # Report the final traceroutes with any additional ones still outstanding
+                                traceroutes = self.traceroute_queue.drain()
+                                traceroutes['final'] = final_traceroutes
+                                self.report_results({}, {}, traceroutes)
+                                self.flush_event.set()
                             else:
                                 logging.info('No clients available for final traceroute at stop_tests command.')
                     elif command == 're_register':
                         logging.info('Received re_register command. Re-registering with server...')
                         self.register()
+                        # Replay anything buffered while we were unknown to the server
+                        self.flush_event.set()
                     if self.running_tests:
+                        roster_started = time.monotonic()
                         clients = self.get_clients()
+                        roster_time = time.monotonic() - roster_started
                         if clients is not None and len(clients) > 1:
-                            results, initial_traceroutes, traceroutes = self.perform_tests(clients)
-                            success = self.report_results(results, initial_traceroutes, traceroutes)
-                            if not success:
-                                logging.error('Server unreachable. Stopping tests and attempting to re-register...')
-                                self.running_tests = False
-                                self.server_available = False
+                            result_rounds, aggregates, initial_traceroutes, traceroutes = self.perform_tests(clients)
+                            self.round_timings['roster'] = roster_time
+                            last = len(result_rounds) - 1
+                            for index, results in enumerate(result_rounds):
+                                round_initial = initial_traceroutes if index == 0 else {}
+                                round_traceroutes = traceroutes if index == last else {}
+                                round_aggregates = aggregates if index == last else None
+                                if results or round_initial or round_traceroutes or round_aggregates:
+                                    self.report_results(results, round_initial, round_traceroutes,
+                                                        self.round_timings if index == last else None,
+                                                        round_aggregates)
                         else:
                             logging.error('No clients available. Stopping tests and attempting to re-register...')
                             self.running_tests = False
+                            self.scheduler.reset()
                             self.server_available = False
+                        # Only the collection cadence, probes run on the scheduler's clock
                         time.sleep(0.5)
                     else:
-                        time.sleep(1)
+                        # Guard against servers that answer long-polls immediately
+                        time.sleep(max(0, 1 - (time.monotonic() - poll_started)))
                 except Exception as e:
                     logging.error('An error occurred in main loop.')
                     logging.error(f"Exception: {e}")
                     traceback.print_exc()
                     logging.error('Server unreachable. Stopping tests and attempting to re-register...')
                     self.running_tests = False
+                    self.scheduler.reset()
                     self.server_available = False
             else:
                 # Try to re-register with the server
                 try:
                     self.register()
                     self.server_available = True
+                    self.flush_event.set()
                 except Exception as e:
                     logging.error(f"Error re-registering with server: {e}")
                     time.sleep(5)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Event loop server mode for large meshes: the client endpoints (/register,
+# /get_commands, /get_clients, /get_targets, /report_results, /ingest) are
+# served natively on aiohttp so thousands of idle long-polls cost a coroutine
+# each instead of a thread. Every other route (dashboard, downloads, APIs) is passed through to
+# the Flask app in server.py on a thread pool. State, JSON contracts and
+# persistence are shared with server.py.
+#
+# Needs aiohttp: pip3 install aiohttp
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import server
+
+PORT = 50000
+# Threads applying ingest batches and other state changes off the event loop.
+# Roster and command lookups run here too, since they wait on server locks a
+# status render can hold for a while.
+INGEST_WORKERS = 8
+# Threads running Flask for the passed-through routes; a dashboard's event
+# stream keeps one busy while it is open
+WSGI_WORKERS = 64
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+wsgi_pool = ThreadPoolExecutor(max_workers=WSGI_WORKERS, thread_name_prefix='wsgi')
+
+def json_response(payload, status=200):
+    return web.json_response(payload, status=status)
+
+async def run_in_pool(pool, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+
+async def register(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    payload, status = await run_in_pool(ingest_pool, server.handle_register, data)
+    return json_response(payload, status)
+
+async def get_commands(request):
+    app = request.app
+    loop = asyncio.get_running_loop()
+    hostname = request.query.get('hostname')
+    deadline = loop.time() + server.command_wait(request.query.get('wait'))
+    while True:
+        # Take the event before looking, so a command queued in between still wakes us
+        event = app['command_events']['current']
+        command = await run_in_pool(ingest_pool, server.take_command, hostname)
+        if command is not None:
+            return json_response(server.command_payload(command))
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return json_response(server.command_payload(None))
+        try:
+            await asyncio.wait_for(event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+async def get_clients(request):
+    since = request.query.get('since')
+    payload = await run_in_pool(ingest_pool, server.roster_response, since)
+    etag = f'"{payload["version"]}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if since is None and etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    return web.json_response(payload, headers=headers)
+
+async def get_targets(request):
+    payload = await run_in_pool(ingest_pool, server.targets_response, request.query.get('hostname'))
+    return json_response(payload)
+
+async def report_results(request):
+    body = await request.read()
+    payload, status = await run_in_pool(ingest_pool, server.handle_report, body,
+                                        request.headers.get('Content-Encoding'))
+    return json_response(payload, status)
+
+async def ingest(request):
+    body = await request.read()
+    payload, status = await run_in_pool(ingest_pool, server.handle_ingest, body,
+                                        request.headers.get('Content-Encoding'))
+    return json_response(payload, status)
+
+def wsgi_environ(request, body):
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': request.host.split(':')[0],
+        'SERVER_PORT': str(PORT),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name in request.headers:
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            continue
+        environ[key] = ','.join(request.headers.getall(name))
+    return environ
+
+# Hand a request to the Flask app and stream its response back chunk by chunk,
+# which keeps the event stream and the zip download streaming
+async def wsgi_passthrough(request):
+    body = await request.read()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = headers
+        return lambda data: None
+
+    iterable = await run_in_pool(wsgi_pool, server.app, wsgi_environ(request, body), start_response)
+    status_code, _, reason = started['status'].partition(' ')
+    response = web.StreamResponse(status=int(status_code), reason=reason or None)
+    for name, value in started['headers']:
+        response.headers.add(name, value)
+    iterator = iter(iterable)
+    try:
+        await response.prepare(request)
+        while True:
+            chunk = await run_in_pool(wsgi_pool, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await response.write(chunk)
+        await response.write_eof()
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close:
+            await run_in_pool(wsgi_pool, close)
+    return response
+
+# Times the natively served endpoints for /metrics; passed-through requests
+# are timed by the Flask app itself
+@web.middleware
+async def time_requests(request, handler):
+    if request.match_info.handler is wsgi_passthrough:
+        return await handler(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    finally:
+        server.observe_request(request.match_info.handler.__name__, status, time.perf_counter() - started)
+
+def create_app():
+    # Gzip bodies are left compressed and decoded on the ingest threads
+    app = web.Application(client_max_size=MAX_BODY_SIZE, middlewares=[time_requests],
+                          handler_args={'auto_decompress': False})
+    app['command_events'] = {}
+    app.router.add_post('/register', register)
+    app.router.add_get('/get_commands', get_commands)
+    app.router.add_get('/get_clients', get_clients)
+    app.router.add_get('/get_targets', get_targets)
+    app.router.add_post('/report_results', report_results)
+    app.router.add_post('/ingest', ingest)
+    app.router.add_route('*', '/{tail:.*}', wsgi_passthrough)
+
+    async def start_command_events(app):
+        loop = asyncio.get_running_loop()
+        events = app['command_events']
+        events['current'] = asyncio.Event()
+
+        def wake_waiters():
+            # Release every current waiter and give later ones a fresh event
+            event, events['current'] = events['current'], asyncio.Event()
+            event.set()
+
+        server.command_listeners.append(lambda: loop.call_soon_threadsafe(wake_waiters))
+
+    async def close_storage(app):
+        await run_in_pool(ingest_pool, server.close_storage)
+
+    app.on_startup.append(start_command_events)
+    app.on_cleanup.append(close_storage)
+    return app
+
+def main():
+    server.open_storage()
+    server.start_liveness_checks()
+    web.run_app(create_app(), host='0.0.0.0', port=PORT, access_log=None)
+
+if __name__ == '__main__':
+    main()
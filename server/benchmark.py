@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# Load generator and benchmark for the server. Starts server.py (or
+# async_server.py) on a spare port with a throwaway data directory, plays N
+# fake clients against it and prints one JSON document with the results, so
+# runs of different versions can be compared:
+#
+#   python3 benchmark.py --clients 200 --duration 30 --output before.json
+#   python3 benchmark.py --clients 200 --duration 30 --baseline before.json
+#
+# The fake clients behave like NetworkTester in client.py: a command poll and
+# a probe round every ROUND_INTERVAL seconds, a roster fetch whenever the
+# announced roster version changes, and a gzip /ingest upload of the buffered
+# rounds every UPLOAD_INTERVAL seconds (or one /report_results per round with
+# --report legacy). Nothing is actually pinged. The load generator competes
+# with the server for CPU on the same machine, keep that in mind on small
+# boxes.
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+ROUND_INTERVAL = 1
+UPLOAD_INTERVAL = 2
+# Share of probes reported as failed
+FAILURE_RATE = 0.01
+STARTUP_TIMEOUT = 30
+# Seconds between /get_status requests while the load runs
+STATUS_SAMPLE_INTERVAL = 1
+TEST_NAME = 'benchmark'
+FAKE_TRACEROUTE = ('traceroute to {ip} ({ip}), 30 hops max, 60 byte packets\n'
+                   ' 1  10.200.0.1  0.412 ms  0.388 ms  0.371 ms\n'
+                   ' 2  {ip}  0.901 ms  0.874 ms  0.866 ms')
+
+# Same record types as the /ingest format in server.py
+RECORD_RESULT = 0
+RECORD_TRACEROUTE = 1
+
+# How each server mode is started, with the data directory and port as arguments
+SERVER_COMMANDS = {
+    'flask': ("import sys, server; server.DATA_DIR = sys.argv[1]; server.open_storage(); "
+              "server.start_liveness_checks(); server.app.run(host='127.0.0.1', port=int(sys.argv[2]))"),
+    'async': ("import sys, server, async_server; server.DATA_DIR = sys.argv[1]; "
+              "async_server.PORT = int(sys.argv[2]); async_server.main()")
+}
+
+class Recorder:
+    """Request latencies per endpoint and ingest counters, shared by all
+    fake clients."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.records = 0
+
+    def request(self, endpoint, call):
+        started = time.perf_counter()
+        try:
+            response = call()
+        except requests.RequestException:
+            response = None
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if response is None or response.status_code >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                response = None
+        return response
+
+    def add_records(self, count):
+        with self.lock:
+            self.records += count
+
+    def summary(self):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors.get(endpoint, 0),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'max_ms': round(latencies[-1] * 1000, 2)
+            }
+        return endpoints
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+class FakeClient(threading.Thread):
+    """One simulated NetworkTester."""
+
+    def __init__(self, index, base_url, recorder, stop_event, report_mode):
+        super().__init__(name=f"fake-client-{index}", daemon=True)
+        self.hostname = f"bench-{index:04d}"
+        self.ip_address = f"10.200.{index // 250}.{index % 250 + 2}"
+        self.base_url = base_url
+        self.recorder = recorder
+        self.stop_event = stop_event
+        self.report_mode = report_mode
+        self.random = random.Random(index)
+        self.session = requests.Session()
+        self.roster = {}
+        self.roster_version = None
+        self.announced_version = None
+        self.traced = set()
+        self.rounds = []
+
+    def register(self):
+        self.recorder.request('register', lambda: self.session.post(
+            self.base_url + '/register', json={'hostname': self.hostname, 'ip_address': self.ip_address}, timeout=30))
+
+    def poll_commands(self):
+        response = self.recorder.request('get_commands', lambda: self.session.get(
+            self.base_url + '/get_commands', params={'hostname': self.hostname}, timeout=30))
+        if response is not None:
+            data = response.json()
+            self.announced_version = data.get('roster_version')
+            if data.get('command') == 're_register':
+                self.register()
+
+    def fetch_roster(self):
+        if self.roster_version is not None and self.roster_version == self.announced_version:
+            return
+        params = {'since': self.roster_version} if self.roster_version is not None else {}
+        response = self.recorder.request('get_clients', lambda: self.session.get(
+            self.base_url + '/get_clients', params=params, timeout=30))
+        if response is None:
+            return
+        data = response.json()
+        if 'changes' in data:
+            for hostname, info in data['changes'].items():
+                if info is None:
+                    self.roster.pop(hostname, None)
+                else:
+                    self.roster[hostname] = info
+        else:
+            self.roster = data.get('clients') or {}
+        self.roster_version = data.get('version')
+
+    def probe_round(self):
+        timestamp = int(time.time())
+        results = []
+        for target, info in self.roster.items():
+            if target == self.hostname:
+                continue
+            if self.random.random() < FAILURE_RATE:
+                results.append((target, info['ip_address'], 0, None))
+            else:
+                results.append((target, info['ip_address'], 1, round(self.random.uniform(0.2, 5.0), 3)))
+        # First sight of a target gets an initial traceroute, like a real client
+        traceroutes = [(target, ip) for target, ip, _, _ in results if target not in self.traced]
+        self.traced.update(target for target, _ in traceroutes)
+        self.rounds.append((timestamp, results, traceroutes))
+
+    def upload(self):
+        rounds, self.rounds = self.rounds, []
+        if self.report_mode == 'legacy':
+            body = self.encode_report(rounds)
+            endpoint, headers = 'report_results', {'Content-Type': 'application/json'}
+        else:
+            body = gzip.compress(self.encode_ingest(rounds))
+            endpoint, headers = 'ingest', {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+        response = self.recorder.request(endpoint, lambda: self.session.post(
+            self.base_url + '/' + endpoint, data=body, headers=headers, timeout=60))
+        if response is not None:
+            self.recorder.add_records(sum(len(results) for _, results, _ in rounds))
+
+    def encode_ingest(self, rounds):
+        # Same layout as NetworkTester.encode_rounds
+        target_index = {}
+        lines = []
+        for timestamp, results, traceroutes in rounds:
+            for target, ip, ok, latency in results:
+                index = target_index.setdefault((target, ip), len(target_index))
+                lines.append([RECORD_RESULT, index, timestamp, ok, latency])
+            for target, ip in traceroutes:
+                index = target_index.setdefault((target, ip), len(target_index))
+                lines.append([RECORD_TRACEROUTE, index, 'initial', timestamp, FAKE_TRACEROUTE.format(ip=ip)])
+        header = {'hostname': self.hostname, 'source_ip': self.ip_address,
+                  'targets': [list(key) for key in target_index]}
+        return ('\n'.join(json.dumps(line, separators=(',', ':')) for line in [header] + lines) + '\n').encode()
+
+    def encode_report(self, rounds):
+        report_rounds = []
+        for timestamp, results, traceroutes in rounds:
+            formatted = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+            report_rounds.append({
+                'timestamp': timestamp,
+                'results': {target: {'result': 'Success' if ok else 'Failure', 'latency': latency,
+                                     'timestamp': formatted, 'source_ip': self.ip_address,
+                                     'destination_ip': ip}
+                            for target, ip, ok, latency in results},
+                'traceroutes': {'initial': {target: FAKE_TRACEROUTE.format(ip=ip) for target, ip in traceroutes}}
+            })
+        return json.dumps({'hostname': self.hostname, 'rounds': report_rounds}).encode()
+
+    def run(self):
+        # Spread the clients over the round so they don't all fire at once
+        next_round = time.monotonic() + self.random.uniform(0, ROUND_INTERVAL)
+        next_upload = next_round + UPLOAD_INTERVAL
+        while not self.stop_event.wait(max(0, next_round - time.monotonic())):
+            self.poll_commands()
+            self.fetch_roster()
+            self.probe_round()
+            now = time.monotonic()
+            if self.report_mode == 'legacy' or now >= next_upload:
+                self.upload()
+                next_upload = now + UPLOAD_INTERVAL
+            # A client that fell behind skips rounds instead of bursting
+            next_round = max(next_round + ROUND_INTERVAL, time.monotonic())
+        if self.rounds:
+            self.upload()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def memory_mb(pid):
+    # Current and peak resident set size from /proc, None where that doesn't exist
+    usage = {'rss': None, 'peak_rss': None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage['rss'] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith('VmHWM:'):
+                    usage['peak_rss'] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return usage
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def start_server(mode, data_dir, port):
+    process = subprocess.Popen([sys.executable, '-c', SERVER_COMMANDS[mode], data_dir, str(port)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup with code {process.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/get_clients", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not come up in time')
+
+def sample_status(base_url, recorder, stop_event):
+    session = requests.Session()
+    while not stop_event.wait(STATUS_SAMPLE_INTERVAL):
+        recorder.request('get_status', lambda: session.get(base_url + '/get_status', timeout=120))
+
+def run_benchmark(args):
+    recorder = Recorder()
+    stop_event = threading.Event()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix='nodepathtest-bench-') as data_dir:
+        process = start_server(args.mode, data_dir, port)
+        try:
+            fake_clients = [FakeClient(index, base_url, recorder, stop_event, args.report)
+                            for index in range(args.clients)]
+            for fake_client in fake_clients:
+                fake_client.register()
+            memory_registered = memory_mb(process.pid)
+            requests.post(base_url + '/start_tests', timeout=30)
+
+            started = time.monotonic()
+            for fake_client in fake_clients:
+                fake_client.start()
+            status_sampler = threading.Thread(target=sample_status, args=(base_url, recorder, stop_event), daemon=True)
+            status_sampler.start()
+            time.sleep(args.duration)
+            stop_event.set()
+            for fake_client in fake_clients:
+                fake_client.join()
+            elapsed = time.monotonic() - started
+            status_sampler.join()
+
+            # The results changed since the last sample, so this is a full render
+            render_started = time.perf_counter()
+            requests.get(base_url + '/get_status', timeout=300)
+            status_render = time.perf_counter() - render_started
+
+            requests.post(base_url + '/stop_tests', timeout=30)
+            download_started = time.perf_counter()
+            download_bytes = 0
+            with requests.get(f"{base_url}/download_results/{TEST_NAME}", stream=True, timeout=600) as response:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    download_bytes += len(chunk)
+            download_time = time.perf_counter() - download_started
+            memory_end = memory_mb(process.pid)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        'benchmark': {
+            'mode': args.mode,
+            'report': args.report,
+            'clients': args.clients,
+            'duration_s': args.duration,
+            'round_interval_s': ROUND_INTERVAL,
+            'upload_interval_s': UPLOAD_INTERVAL,
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'started': time.strftime('%Y-%m-%d %H:%M:%S')
+        },
+        'ingest': {
+            'records': recorder.records,
+            'records_per_s': round(recorder.records / elapsed, 1)
+        },
+        'endpoints': recorder.summary(),
+        'get_status_render_ms': round(status_render * 1000, 2),
+        'download': {
+            'seconds': round(download_time, 3),
+            'bytes': download_bytes
+        },
+        'server_memory_mb': {
+            'after_register': memory_registered['rss'],
+            'end': memory_end['rss'],
+            'peak': memory_end['peak_rss']
+        }
+    }
+
+def flatten(document, prefix=''):
+    values = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+def compare(baseline, current):
+    old, new = flatten(baseline), flatten(current)
+    lines = [f"{'metric':<40} {'baseline':>12} {'current':>12} {'change':>8}"]
+    for key in sorted(old.keys() & new.keys()):
+        if key.startswith('benchmark.'):
+            continue
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else ''
+        lines.append(f"{key:<40} {old[key]:>12} {new[key]:>12} {change:>8}")
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the nodepathtest server with simulated clients.')
+    parser.add_argument('--clients', type=int, default=50, help='number of simulated clients (default 50)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after start_tests (default 30)')
+    parser.add_argument('--mode', choices=sorted(SERVER_COMMANDS), default='flask',
+                        help='server.py (flask) or async_server.py (async)')
+    parser.add_argument('--report', choices=('ingest', 'legacy'), default='ingest',
+                        help='upload batches to /ingest or send every round to /report_results')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    document = json.dumps(results, indent=2)
+    print(document)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
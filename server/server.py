@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify, render_template_string, send_file, url_for
+from flask import Flask, Response, request, jsonify, render_template_string, url_for, make_response, g
 import threading
+import time
+import uuid
+from contextlib import contextmanager
+from collections import deque
 from datetime import datetime
+import os
+import sys
+import signal
+import queue
+import pickle
+import struct
 import zipfile
-import io
 import json
+import gzip
+import math
+import heapq
+import re
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from jinja2 import Template
 
 app = Flask(__name__)
@@ -17,6 +35,919 @@ current_test_name = ''
 client_commands = {}
 initial_traceroutes_sent = {}
 
+# Upper bound in seconds for a long-polling /get_commands request
+COMMAND_WAIT_MAX = 30
+
+# Liveness: a client that hasn't polled for commands or sent results for
+# CLIENT_STALE_AFTER seconds is marked stale, and after CLIENT_EVICT_AFTER
+# seconds it is dropped from the roster so nobody probes it any more. Its
+# results stay. last_seen holds monotonic heartbeat times; liveness_heap
+# holds (deadline, hostname) checks, which are re-armed from last_seen when
+# they come due instead of on every heartbeat. liveness_due names the one
+# current check per client, superseded heap entries are skipped.
+CLIENT_STALE_AFTER = 90
+CLIENT_EVICT_AFTER = 600
+LIVENESS_CHECK_INTERVAL = 1
+last_seen = {}
+stale_clients = set()
+liveness_heap = []
+liveness_due = {}
+liveness_lock = threading.Lock()
+# Signalled whenever a command is queued in client_commands
+commands_condition = threading.Condition()
+
+# Bumped on every change to the status matrix. results_journal keeps the
+# (version, node1, node2) cells changed per version so /status_stream can send
+# deltas; changes that can't be expressed as cell updates (roster, start/stop,
+# clear) set resync_version and force a full snapshot instead.
+RESULTS_JOURNAL_SIZE = 100000
+STATUS_STREAM_KEEPALIVE = 15
+results_version = 0
+resync_version = 0
+journal_floor = 0
+results_journal = deque(maxlen=RESULTS_JOURNAL_SIZE)
+results_condition = threading.Condition()
+
+# Bumped whenever a client joins or changes address. roster_journal keeps the
+# (version, hostname) changed per version so /get_clients can send a client
+# only the entries changed since the roster version it already holds.
+ROSTER_JOURNAL_SIZE = 10000
+roster_version = 0
+roster_journal = deque(maxlen=ROSTER_JOURNAL_SIZE)
+
+# Partial mesh sampling for very large labs: with SAMPLE_TARGETS > 0 each
+# client probes only that many peers per SAMPLE_EPOCH seconds (see
+# sample_targets), and every ordered pair is still probed at least once every
+# ceil((N - 1) / SAMPLE_TARGETS) epochs. 0 keeps the full mesh.
+SAMPLE_TARGETS = 0
+SAMPLE_EPOCH = 60
+# (roster_version, sorted hostnames) the samples are cut from
+sorted_roster = (None, [])
+
+# Rendered dashboard fragments keyed on results_version, served with an ETag so
+# unchanged fragments cost neither a render nor a body. The boot id keeps ETags
+# from a previous server run from matching.
+BOOT_ID = uuid.uuid4().hex[:8]
+fragment_cache = {}
+
+# Probe results kept per node pair; older entries are overwritten once a pair
+# holds HISTORY_RETENTION of them
+HISTORY_RETENTION = 100000
+# Default and maximum number of history rows per detailed results page
+DETAIL_PAGE_SIZE = 500
+DETAIL_PAGE_SIZE_MAX = 10000
+# Workers rendering per-pair pages for /download_results
+EXPORT_WORKERS = 4
+
+# Durable state: every change is appended to a segment log in DATA_DIR and the
+# full state is snapshotted every SNAPSHOT_INTERVAL seconds, so a restart only
+# replays the log written since the last snapshot. Set DATA_DIR to None to run
+# purely in memory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SNAPSHOT_INTERVAL = 300
+LOG_FLUSH_INTERVAL = 1
+
+# Latency histogram buckets (seconds) for /metrics, and the round phases
+# clients report timings for
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CLIENT_PHASES = ('roster', 'probe', 'traceroute', 'upload')
+
+class SharedLock:
+    """Readers-writer lock. Any number of threads can hold shared() at once;
+    exclusive() waits for them to leave and holds off new ones meanwhile."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.holders = 0
+        self.exclusive_held = False
+        self.exclusive_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self.condition:
+            while self.exclusive_held or self.exclusive_waiting:
+                self.condition.wait()
+            self.holders += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.holders -= 1
+                if not self.holders:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            while self.exclusive_held or self.holders:
+                self.condition.wait()
+            self.exclusive_waiting -= 1
+            self.exclusive_held = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive_held = False
+                self.condition.notify_all()
+
+# Locking of the shared state:
+# - state_lock is held shared by every change that is logged (ingest, reports,
+#   register) and exclusively by start, clear and the start of a snapshot, so
+#   a snapshot always matches a position in the log (see write_snapshot).
+# - structure_lock guards adding and removing keys in clients, test_results and
+#   test_history; readers copy what they iterate under it.
+# - A pair's counts, history, rollups and traceroutes are only touched under
+#   its stripe of pair_locks, so ingest for different pairs runs in parallel.
+STATE_STRIPES = 64
+state_lock = SharedLock()
+structure_lock = threading.Lock()
+pair_locks = [threading.Lock() for _ in range(STATE_STRIPES)]
+
+def pair_lock(key):
+    return pair_locks[hash(key) % STATE_STRIPES]
+
+class PairHistory:
+    """Bounded history of one node pair stored as packed columns in a ring
+    buffer: epoch timestamp, latency (NaN when missing) and result. Source and
+    destination IPs are kept once per change rather than per entry. Iterating
+    yields the same dicts the history list used to hold.
+
+    Entries arrive in time order, so time ranges are found by binary search on
+    the timestamp column, and the sequence numbers of failures are indexed so
+    failure-only pages don't scan the successes in between."""
+
+    def __init__(self, capacity=HISTORY_RETENTION):
+        self.capacity = capacity
+        self.times = array('d')
+        self.latencies = array('d')
+        self.results = array('b')
+        self.start = 0  # Slot of the oldest entry once the ring is full
+        self.total = 0  # Entries ever appended
+        # (first sequence number, source_ip, destination_ip) per IP change
+        self.ip_changes = []
+        self.ip_change_seqs = []
+        # Sequence numbers of failed entries, live from fail_head onwards
+        self.fail_seqs = array('q')
+        self.fail_head = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp, success, latency, source_ip, destination_ip):
+        if not self.ip_changes or self.ip_changes[-1][1:] != (source_ip, destination_ip):
+            self.ip_changes.append((self.total, source_ip, destination_ip))
+            self.ip_change_seqs.append(self.total)
+        latency = math.nan if latency is None else latency
+        if not success:
+            self.fail_seqs.append(self.total)
+        if len(self.times) < self.capacity:
+            self.times.append(timestamp)
+            self.latencies.append(latency)
+            self.results.append(1 if success else 0)
+        else:
+            slot = self.start
+            self.times[slot] = timestamp
+            self.latencies[slot] = latency
+            self.results[slot] = 1 if success else 0
+            self.start = (slot + 1) % self.capacity
+            # Forget IP changes that only covered overwritten entries
+            first_seq = self.total - self.capacity + 1
+            while len(self.ip_change_seqs) > 1 and self.ip_change_seqs[1] <= first_seq:
+                del self.ip_changes[0]
+                del self.ip_change_seqs[0]
+            while self.fail_head < len(self.fail_seqs) and self.fail_seqs[self.fail_head] < first_seq:
+                self.fail_head += 1
+            if self.fail_head > 1024 and self.fail_head * 2 > len(self.fail_seqs):
+                del self.fail_seqs[:self.fail_head]
+                self.fail_head = 0
+        self.total += 1
+
+    def copy(self):
+        # Independent copy of the columns, cheap enough to take under the pair lock
+        clone = PairHistory.__new__(PairHistory)
+        clone.__dict__.update(self.__dict__)
+        clone.times = array('d', self.times)
+        clone.latencies = array('d', self.latencies)
+        clone.results = array('b', self.results)
+        clone.ip_changes = list(self.ip_changes)
+        clone.ip_change_seqs = list(self.ip_change_seqs)
+        clone.fail_seqs = array('q', self.fail_seqs)
+        return clone
+
+    def time_at(self, index):
+        return self.times[(self.start + index) % len(self.times)]
+
+    def bisect_time(self, timestamp, right=False):
+        # First logical index whose time is >= timestamp (> with right=True)
+        lo, hi = 0, len(self.times)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.time_at(mid)
+            if value < timestamp or (right and value == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, start_time=None, end_time=None, failures_only=False, offset=0, limit=DETAIL_PAGE_SIZE):
+        # Returns (matching entries in total, entries of the requested page)
+        lo = 0 if start_time is None else self.bisect_time(start_time)
+        hi = len(self.times) if end_time is None else self.bisect_time(end_time, right=True)
+        if hi <= lo:
+            return 0, []
+        if not failures_only:
+            return hi - lo, list(self.entries(lo + offset, min(lo + offset + limit, hi)))
+        base = self.total - len(self.times)
+        first = bisect_left(self.fail_seqs, base + lo, self.fail_head)
+        last = bisect_left(self.fail_seqs, base + hi, first)
+        page = self.fail_seqs[first + offset:min(first + offset + limit, last)]
+        return last - first, [self.entry(seq - base) for seq in page]
+
+    def entry(self, index):
+        # Entry at logical index (0 is the oldest retained one) as a dict
+        slot = (self.start + index) % len(self.times)
+        seq = self.total - len(self.times) + index
+        _, source_ip, destination_ip = self.ip_changes[bisect_right(self.ip_change_seqs, seq) - 1]
+        latency = self.latencies[slot]
+        return {
+            'timestamp': format_timestamp(self.times[slot]),
+            'result': 'Success' if self.results[slot] else 'Fail',
+            'latency': None if math.isnan(latency) else latency,
+            'source_ip': source_ip,
+            'destination_ip': destination_ip
+        }
+
+    def entries(self, start=0, stop=None):
+        stop = len(self.times) if stop is None else min(stop, len(self.times))
+        for index in range(start, stop):
+            yield self.entry(index)
+
+    def __iter__(self):
+        return self.entries()
+
+# Rolling aggregates kept per pair next to the raw history, as (bucket width
+# in seconds, buckets kept) per resolution. They outlive the raw entries.
+ROLLUP_RESOLUTIONS = ((1, 300), (60, 1440), (3600, 720))
+# Relative error of the latency quantiles reported from a LatencySketch
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_MIN_LATENCY = 0.001
+
+class LatencySketch:
+    """Mergeable latency quantile sketch: a histogram over logarithmic buckets
+    where bucket k holds values in (gamma^(k-1), gamma^k]. Merging adds bucket
+    counts and quantiles are within SKETCH_RELATIVE_ACCURACY of the truth."""
+
+    __slots__ = ('buckets', 'count')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value, count=1):
+        key = math.ceil(math.log(max(value, SKETCH_MIN_LATENCY)) / SKETCH_LOG_GAMMA)
+        self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return round(2 * SKETCH_GAMMA ** key / (SKETCH_GAMMA + 1), 3)
+        return None
+
+class RollupBucket:
+    # jitter_total / jitter_weight: latency-weighted jitter of client-side
+    # window aggregates, single results carry no jitter
+    __slots__ = ('count', 'lost', 'min', 'max', 'total', 'sketch', 'jitter_total', 'jitter_weight')
+
+    def __init__(self):
+        self.count = 0
+        self.lost = 0
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.sketch = LatencySketch()
+        self.jitter_total = 0.0
+        self.jitter_weight = 0
+
+    def add(self, success, latency):
+        self.count += 1
+        if not success:
+            self.lost += 1
+        elif latency is not None:
+            self.min = latency if self.min is None else min(self.min, latency)
+            self.max = latency if self.max is None else max(self.max, latency)
+            self.total += latency
+            self.sketch.add(latency)
+
+    def merge(self, other):
+        self.count += other.count
+        self.lost += other.lost
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.total += other.total
+        self.sketch.merge(other.sketch)
+        self.jitter_total += other.jitter_total
+        self.jitter_weight += other.jitter_weight
+
+    def copy(self):
+        return restore_rollup_bucket(self.count, self.lost, self.min, self.max, self.total, dict(self.sketch.buckets),
+                                     self.sketch.count, self.jitter_total, self.jitter_weight)
+
+    def __reduce__(self):
+        # Flat tuple pickles several times faster than the default slots state
+        return restore_rollup_bucket, (self.count, self.lost, self.min, self.max, self.total,
+                                       self.sketch.buckets, self.sketch.count, self.jitter_total, self.jitter_weight)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'lost': self.lost,
+            'loss': round(self.lost / self.count, 4) if self.count else None,
+            'min': self.min,
+            'avg': round(self.total / self.sketch.count, 3) if self.sketch.count else None,
+            'max': self.max,
+            'p50': self.sketch.quantile(0.5),
+            'p90': self.sketch.quantile(0.9),
+            'p99': self.sketch.quantile(0.99),
+            'jitter': round(self.jitter_total / self.jitter_weight, 3) if self.jitter_weight else None
+        }
+
+def restore_rollup_bucket(count, lost, minimum, maximum, total, sketch_buckets, sketch_count,
+                          jitter_total=0.0, jitter_weight=0):
+    bucket = RollupBucket()
+    bucket.count, bucket.lost, bucket.min, bucket.max, bucket.total = count, lost, minimum, maximum, total
+    bucket.sketch.buckets, bucket.sketch.count = sketch_buckets, sketch_count
+    bucket.jitter_total, bucket.jitter_weight = jitter_total, jitter_weight
+    return bucket
+
+class PairRollups:
+    """Count, loss, min/avg/max and a latency sketch per time bucket at each
+    of ROLLUP_RESOLUTIONS, oldest buckets dropped beyond the kept count."""
+
+    def __init__(self, resolutions=ROLLUP_RESOLUTIONS):
+        self.resolutions = dict(resolutions)
+        self.buckets = {width: {} for width in self.resolutions}  # width -> {start: RollupBucket}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buckets = {width: dict(sorted(buckets.items())) for width, buckets in self.buckets.items()}
+
+    def bucket(self, width, timestamp):
+        # Returns None for a timestamp older than the buckets kept at width.
+        # Each width's dict is kept in time order, so the first key is the oldest.
+        start = int(timestamp // width * width)
+        buckets = self.buckets[width]
+        bucket = buckets.get(start)
+        if bucket is None:
+            if len(buckets) >= self.resolutions[width]:
+                oldest = next(iter(buckets))
+                if start < oldest:
+                    return None
+                del buckets[oldest]
+            newest = next(reversed(buckets), None)
+            bucket = buckets[start] = RollupBucket()
+            if newest is not None and start < newest:
+                # Late and replayed results are rare, re-sort for them only
+                self.buckets[width] = dict(sorted(buckets.items()))
+        return bucket
+
+    def add(self, timestamp, success, latency):
+        for width in self.buckets:
+            bucket = self.bucket(width, timestamp)
+            if bucket is not None:
+                bucket.add(success, latency)
+
+    def copy(self):
+        clone = PairRollups.__new__(PairRollups)
+        clone.resolutions = self.resolutions
+        clone.buckets = {width: {start: bucket.copy() for start, bucket in buckets.items()}
+                         for width, buckets in self.buckets.items()}
+        return clone
+
+    def add_bucket(self, timestamp, other):
+        # A pre-aggregated window lands whole in the bucket its start falls in
+        for width in self.buckets:
+            bucket = self.bucket(width, timestamp)
+            if bucket is not None:
+                bucket.merge(other)
+
+    def query(self, width, start_time=None, end_time=None):
+        # Returns the buckets in range and one bucket merging all of them
+        merged = RollupBucket()
+        selected = []
+        for start in sorted(self.buckets[width]):
+            if (start_time is not None and start + width <= start_time) or (end_time is not None and start > end_time):
+                continue
+            bucket = self.buckets[width][start]
+            merged.merge(bucket)
+            selected.append(dict(bucket.summary(), start=start))
+        return selected, merged.summary()
+
+# Traceroutes are stored once per distinct path. An output is parsed into its
+# header line and hops (address plus any !H style flag, None where no reply
+# came), and trace_paths maps the path id, a hash of header and hops, to that
+# TracePath. A pair only keeps (path_id, hop RTTs) per traceroute, so pairs
+# along the same route share a path and a route change is a change of path id.
+# Outputs that don't render back to exactly the same text are kept verbatim.
+TRACE_HOP = re.compile(r'\s*(\d+)  (?:(\S+)  (\d+\.\d{3}) ms(.*)|\*)$')
+trace_paths = {}
+
+class TracePath:
+    __slots__ = ('header', 'hops', 'raw')
+
+    def __init__(self, header, hops, raw=None):
+        self.header = header
+        self.hops = hops  # ((hop_ip, flag) or None, ...) from the first hop on
+        self.raw = raw
+
+    def path_id(self):
+        return hashlib.blake2b(repr((self.header, self.hops, self.raw)).encode(), digest_size=8).hexdigest()
+
+    def render(self, rtts):
+        # Same layout as `traceroute -n -q 1` and the client's TTLTracer
+        if self.raw is not None:
+            return self.raw
+        lines = [self.header]
+        for ttl, (hop, rtt) in enumerate(zip(self.hops, rtts), 1):
+            if hop is None:
+                lines.append(f"{ttl:2d}  *")
+            else:
+                lines.append(f"{ttl:2d}  {hop[0]}  {rtt:.3f} ms{hop[1]}")
+        return '\n'.join(lines) + '\n'
+
+def parse_traceroute(output):
+    # (TracePath, hop RTTs) of a traceroute output, None if it doesn't parse
+    lines = output.split('\n')
+    if len(lines) < 2 or lines[-1]:
+        return None
+    hops = []
+    rtts = array('f')
+    for ttl, line in enumerate(lines[1:-1], 1):
+        match = TRACE_HOP.match(line)
+        if match is None or int(match.group(1)) != ttl:
+            return None
+        if match.group(2) is None:
+            hops.append(None)
+            rtts.append(0.0)
+        else:
+            hops.append((match.group(2), match.group(4)))
+            rtts.append(float(match.group(3)))
+    return TracePath(lines[0], tuple(hops)), rtts
+
+# Store a traceroute output, returns the (path_id, rtts) that stands for it
+def intern_traceroute(output):
+    if not output:
+        return None
+    parsed = parse_traceroute(output)
+    if parsed is None or parsed[0].render(parsed[1]) != output:
+        parsed = TracePath(None, (), output), None
+    path, rtts = parsed
+    # Interned so every traceroute along a path shares one id string
+    path_id = sys.intern(path.path_id())
+    # Ingest threads of different pairs may race to add the same path, either copy will do
+    trace_paths.setdefault(path_id, path)
+    return path_id, rtts
+
+def render_traceroute(trace):
+    if trace is None:
+        return ''
+    path_id, rtts = trace
+    return trace_paths[path_id].render(rtts)
+
+# Snapshots from before path interning hold the traceroute text
+def intern_legacy_traceroutes(traceroutes):
+    for kind in ('initial', 'final'):
+        if isinstance(traceroutes.get(kind), str):
+            traceroutes[kind] = intern_traceroute(traceroutes[kind])
+    traceroutes['additional'] = [(entry['timestamp'], intern_traceroute(entry['output'])) if isinstance(entry, dict)
+                                 else entry for entry in traceroutes.get('additional', [])]
+
+class Histogram:
+    """Fixed-bucket latency histogram, rendered in the Prometheus text format.
+    Observing is one bisect and three additions; callers hold metrics_lock."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+# Counters behind /metrics
+metrics_lock = threading.Lock()
+request_durations = {}  # endpoint -> Histogram
+request_counts = {}  # (endpoint, status code) -> requests
+ingested_records = 0
+client_timings = {}  # hostname -> {phase: seconds} of its latest batch
+
+def observe_request(endpoint, status, seconds):
+    with metrics_lock:
+        histogram = request_durations.get(endpoint)
+        if histogram is None:
+            histogram = request_durations[endpoint] = Histogram()
+        histogram.observe(seconds)
+        request_counts[(endpoint, status)] = request_counts.get((endpoint, status), 0) + 1
+
+def record_ingest(hostname, count, timings=None):
+    global ingested_records
+    with metrics_lock:
+        ingested_records += count
+        if isinstance(timings, dict):
+            client_timings[hostname] = {phase: float(timings[phase]) for phase in CLIENT_PHASES
+                                        if isinstance(timings.get(phase), (int, float))}
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics():
+    lines = []
+
+    def describe(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with structure_lock:
+        client_count = len(clients)
+        stale_count = len(stale_clients)
+        pair_count = len(test_history)
+        history_entries = sum(len(data['history']) for data in test_history.values())
+        path_count = len(trace_paths)
+    with commands_condition:
+        pending_commands = len(client_commands)
+    with metrics_lock:
+        describe('nodepathtest_requests_total', 'counter', 'HTTP requests by endpoint and status code.')
+        for (endpoint, status), count in sorted(request_counts.items()):
+            lines.append(f'nodepathtest_requests_total{{endpoint="{label_value(endpoint)}",code="{status}"}} {count}')
+        describe('nodepathtest_request_duration_seconds', 'histogram', 'Time to answer a request, including streaming the body.')
+        for endpoint, histogram in sorted(request_durations.items()):
+            lines.extend(histogram.render('nodepathtest_request_duration_seconds', f'endpoint="{label_value(endpoint)}"'))
+        describe('nodepathtest_ingested_records_total', 'counter', 'Result and traceroute records received from clients.')
+        lines.append(f"nodepathtest_ingested_records_total {ingested_records}")
+        describe('nodepathtest_client_phase_seconds', 'gauge', 'Time a client spent per round phase in its latest upload.')
+        for hostname, timings in sorted(client_timings.items()):
+            for phase, seconds in timings.items():
+                lines.append(f'nodepathtest_client_phase_seconds{{client="{label_value(hostname)}",phase="{phase}"}} {seconds:.6f}')
+    describe('nodepathtest_clients', 'gauge', 'Registered clients by liveness.')
+    lines.append(f'nodepathtest_clients{{state="live"}} {client_count - stale_count}')
+    lines.append(f'nodepathtest_clients{{state="stale"}} {stale_count}')
+    describe('nodepathtest_pending_commands', 'gauge', 'Commands queued for clients that have not polled yet.')
+    lines.append(f"nodepathtest_pending_commands {pending_commands}")
+    describe('nodepathtest_history_pairs', 'gauge', 'Node pairs with stored history.')
+    lines.append(f"nodepathtest_history_pairs {pair_count}")
+    describe('nodepathtest_history_entries', 'gauge', 'Probe results held in the per-pair history.')
+    lines.append(f"nodepathtest_history_entries {history_entries}")
+    describe('nodepathtest_trace_paths', 'gauge', 'Distinct traceroute paths stored.')
+    lines.append(f"nodepathtest_trace_paths {path_count}")
+    if results_log is not None:
+        describe('nodepathtest_results_log_ok', 'gauge', '1 while state changes are written to the results log, 0 after a write failed.')
+        lines.append(f"nodepathtest_results_log_ok {int(results_log.error is None)}")
+    memory = resident_memory_bytes()
+    if memory is not None:
+        describe('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes.')
+        lines.append(f"process_resident_memory_bytes {memory}")
+    return '\n'.join(lines) + '\n'
+
+# Log record types
+OP_REGISTER = 1
+OP_START = 2
+OP_STOP = 3
+OP_CLEAR = 4
+OP_REPORT = 5
+OP_INGEST = 6
+OP_EVICT = 7
+LOG_RECORD_HEADER = struct.Struct('!IB')
+
+class ResultsLog:
+    """Append-only log of state changes split into numbered segment files.
+    Records are length-prefixed (4 byte length, 1 byte type, payload) and
+    written by a background thread, so appending from a request only costs a
+    queue put. A snapshot starts a new segment; segments before the one named
+    in the snapshot are no longer needed and get removed. If writing fails
+    the log is switched off and `error` says why; appends are dropped from
+    then on rather than queued forever."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.queue = queue.Queue()
+        self.segment = None
+        self.thread = None
+        self.log_file = None
+        self.error = None
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:08d}.log")
+
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name.endswith('.log'):
+                found.append(int(name[8:-4]))
+        return sorted(found)
+
+    def open(self):
+        # Always start a fresh segment, the last one may end in a torn record
+        existing = self.segments()
+        self.segment = (existing[-1] + 1) if existing else 1
+        # Opened here rather than in the writer, so an unwritable data
+        # directory stops the server before it accepts anything
+        self.log_file = open(self.segment_path(self.segment), 'ab')
+        self.thread = threading.Thread(target=self.run, name='results-log', daemon=True)
+        self.thread.start()
+
+    def append(self, op, payload):
+        if self.segment is not None and self.error is None:
+            self.queue.put((op, payload))
+
+    def rotate(self):
+        # Must be called under state_lock; records appended afterwards go to the new segment
+        self.segment += 1
+        self.queue.put((None, self.segment))
+        return self.segment
+
+    def close(self):
+        # Write out whatever is queued and stop the writer thread
+        if self.thread is not None:
+            self.queue.put((None, None))
+            self.thread.join()
+            self.thread = None
+            self.segment = None
+
+    def remove_before(self, segment):
+        for old in self.segments():
+            if old < segment:
+                os.remove(self.segment_path(old))
+
+    def fail(self, log_file, error):
+        self.error = str(error)
+        print(f"ERROR: writing the results log failed, changes are no longer persisted "
+              f"until the server is restarted: {error}")
+        if log_file is not None:
+            try:
+                log_file.close()
+            except OSError:
+                pass
+
+    def run(self):
+        log_file = self.log_file
+        dirty = False
+        while True:
+            try:
+                op, payload = self.queue.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                if dirty and log_file is not None:
+                    try:
+                        log_file.flush()
+                        os.fsync(log_file.fileno())
+                    except OSError as e:
+                        self.fail(log_file, e)
+                        log_file = None
+                    dirty = False
+                continue
+            if log_file is None:
+                # Failed earlier, drain the queue until close()
+                if op is None and payload is None:
+                    return
+                continue
+            try:
+                if op is None:
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+                    log_file.close()
+                    if payload is None:
+                        return
+                    log_file = None
+                    log_file = open(self.segment_path(payload), 'ab')
+                    dirty = False
+                    continue
+                log_file.write(LOG_RECORD_HEADER.pack(len(payload), op))
+                log_file.write(payload)
+                dirty = True
+            except OSError as e:
+                self.fail(log_file, e)
+                log_file = None
+                if op is None and payload is None:
+                    return
+
+    def replay(self, first_segment):
+        # Yields (op, payload) of every complete record from first_segment on
+        for segment in self.segments():
+            if segment < first_segment:
+                continue
+            with open(self.segment_path(segment), 'rb') as f:
+                while True:
+                    header = f.read(LOG_RECORD_HEADER.size)
+                    if len(header) < LOG_RECORD_HEADER.size:
+                        break
+                    length, op = LOG_RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        print(f"Ignoring torn record at the end of segment {segment}")
+                        break
+                    yield op, payload
+
+# Globals a snapshot may reference; anything else in the file is refused
+SNAPSHOT_STATE_NAMES = frozenset(('PairHistory', 'PairRollups', 'restore_rollup_bucket', 'TracePath'))
+SNAPSHOT_OTHER_GLOBALS = frozenset((('array', 'array'), ('array', '_array_reconstructor')))
+
+class StateUnpickler(pickle.Unpickler):
+    # Snapshots may come from this file run as a script or imported as a module
+    def find_class(self, module, name):
+        if module in ('__main__', 'server') and name in SNAPSHOT_STATE_NAMES:
+            return getattr(sys.modules[__name__], name)
+        if (module, name) in SNAPSHOT_OTHER_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Snapshot refers to {module}.{name}, which is not part of the state")
+
+results_log = None
+
+def snapshot_path():
+    return os.path.join(DATA_DIR, 'snapshot.pickle')
+
+# Snapshots are copy-on-write so ingest only waits for the log rotation and a
+# copy of the small structures. While one is written, snapshot_pending maps the
+# pairs it still has to copy to their state, and the first change to such a
+# pair copies it into snapshot_copies before going ahead (preserve_pair). Both
+# are only touched under the pair's lock.
+snapshot_pending = None
+snapshot_copies = {}
+
+def copy_pair(pair):
+    return {'history': pair['history'].copy(), 'rollups': pair['rollups'].copy(), 'last': pair.get('last', 0),
+            'traceroutes': dict(pair['traceroutes'], additional=list(pair['traceroutes']['additional']))}
+
+# Call with the pair's lock held, before changing its history, rollups or traceroutes
+def preserve_pair(key, pair):
+    pending = snapshot_pending
+    if pending is not None and pending.get(key) is pair:
+        snapshot_copies[key] = copy_pair(pair)
+        del pending[key]
+
+def write_snapshot():
+    global snapshot_pending, snapshot_copies
+    with state_lock.exclusive():
+        segment = results_log.rotate()
+        state = {
+            'segment': segment,
+            'clients': dict(clients),
+            'test_results': {node1: {node2: dict(counts) for node2, counts in targets.items()}
+                             for node1, targets in test_results.items()},
+            'trace_paths': dict(trace_paths),
+            'ingest_batches': dict(ingest_batches),
+            'running_tests': running_tests,
+            'current_test_name': current_test_name
+        }
+        snapshot_copies = {}
+        snapshot_pending = dict(test_history)
+    try:
+        # Pairs changed since the rotation were copied before the change
+        for key in list(snapshot_pending):
+            with pair_lock(key):
+                pair = snapshot_pending.pop(key, None)
+                if pair is not None:
+                    snapshot_copies[key] = copy_pair(pair)
+        state['test_history'] = snapshot_copies
+    finally:
+        snapshot_pending = None
+        snapshot_copies = {}
+    temp_path = snapshot_path() + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, snapshot_path())
+    results_log.remove_before(segment)
+
+def snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+
+def apply_log_record(op, payload):
+    if op == OP_REGISTER:
+        data = json.loads(payload)
+        apply_register(data['hostname'], data['ip_address'])
+    elif op == OP_START:
+        apply_start_tests()
+    elif op == OP_STOP:
+        apply_stop_tests()
+    elif op == OP_CLEAR:
+        apply_clear_data()
+    elif op == OP_REPORT:
+        apply_report(*parse_report(json.loads(payload)))
+    elif op == OP_INGEST:
+        header, by_target = parse_records(payload)
+        claim_batch(header['hostname'], header.get('batch'))
+        apply_records(header, by_target)
+    elif op == OP_EVICT:
+        apply_evict(payload.decode())
+
+# Load the last snapshot, replay the log written after it and start logging
+def open_storage():
+    global results_log, running_tests, current_test_name
+    if DATA_DIR is None:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    results_log = ResultsLog(DATA_DIR)
+    first_segment = 0
+    started = time.monotonic()
+    if os.path.exists(snapshot_path()):
+        with open(snapshot_path(), 'rb') as f:
+            snapshot = StateUnpickler(f).load()
+        clients.update(snapshot['clients'])
+        test_results.update(snapshot['test_results'])
+        test_history.update(snapshot['test_history'])
+        trace_paths.update(snapshot.get('trace_paths', {}))
+        ingest_batches.update(snapshot.get('ingest_batches', {}))
+        if 'trace_paths' not in snapshot:
+            for data in test_history.values():
+                intern_legacy_traceroutes(data['traceroutes'])
+        running_tests = snapshot['running_tests']
+        current_test_name = snapshot['current_test_name']
+        first_segment = snapshot['segment']
+    replayed = 0
+    for op, payload in results_log.replay(first_segment):
+        try:
+            apply_log_record(op, payload)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Skipping unreadable log record: {e}")
+        replayed += 1
+    mark_results_changed()
+    print(f"Recovered {len(clients)} clients and {len(test_history)} pairs, "
+          f"replayed {replayed} log records in {time.monotonic() - started:.1f}s")
+    results_log.open()
+    threading.Thread(target=snapshot_loop, name='snapshots', daemon=True).start()
+
+def close_storage():
+    if results_log is not None:
+        results_log.close()
+
+def log_change(op, payload=b''):
+    if results_log is not None:
+        results_log.append(op, payload)
+
+# Timestamps repeat for every target of a round, so memoise the conversions
+timestamp_cache = {}
+
+def format_timestamp(epoch):
+    formatted = timestamp_cache.get(epoch)
+    if formatted is None:
+        if len(timestamp_cache) > 10000:
+            timestamp_cache.clear()
+        formatted = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(epoch))
+        timestamp_cache[epoch] = formatted
+    return formatted
+
+def parse_timestamp(timestamp):
+    epoch = timestamp_cache.get(timestamp)
+    if epoch is None:
+        if len(timestamp_cache) > 10000:
+            timestamp_cache.clear()
+        epoch = time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+        timestamp_cache[timestamp] = epoch
+    return epoch
+
 # Embedded HTML templates
 index_html = """
 <!doctype html>
@@ -89,6 +1020,12 @@ index_html = """
         .red-bg {
             background-color: #FF6347;
         }
+        th.stale, tr td.stale:first-child {
+            background-color: #9E9E9E;
+        }
+        td.aged {
+            opacity: 0.4;
+        }
     </style>
 </head>
 <body>
@@ -104,17 +1041,79 @@ index_html = """
 
     <script>
         function loadContent() {
-            fetch('/get_status')
-                .then(response => response.text())
-                .then(html => {
-                    document.getElementById('dynamic-content').innerHTML = html;
-                });
+            return Promise.all([
+                fetch('/get_status')
+                    .then(response => response.text())
+                    .then(html => {
+                        document.getElementById('dynamic-content').innerHTML = html;
+                    }),
+                fetch('/get_buttons')
+                    .then(response => response.text())
+                    .then(html => {
+                        document.getElementById('static-content').innerHTML = html;
+                    })
+            ]);
+        }
 
-            fetch('/get_buttons')
-                .then(response => response.text())
-                .then(html => {
-                    document.getElementById('static-content').innerHTML = html;
+        // Update a single matrix cell in place from a [node1, node2, success, fail, last] entry
+        function updateCell(cell) {
+            const [node1, node2, success, fail, last] = cell;
+            const td = document.getElementById('cell|' + node1 + '|' + node2);
+            if (!td) {
+                return;
+            }
+            td.className = fail == 0 ? 'green-bg' : (fail <= 5 ? 'orange-bg' : 'red-bg');
+            td.querySelector('.green-text').textContent = success;
+            td.querySelector('.red-text').textContent = fail;
+            if (last) {
+                td.dataset.last = last;
+            }
+            markAge(td);
+        }
+
+        // Server clock minus browser clock, taken from the status stream
+        let clockOffset = 0;
+
+        // With sampling on, fade cells whose newest result is older than the coverage cycle
+        function markAge(td) {
+            const table = document.getElementById('status-table');
+            if (!table || !table.dataset.coverage || !td.dataset.last) {
+                return;
+            }
+            const age = Math.max(0, Math.round(Date.now() / 1000 + clockOffset - td.dataset.last));
+            td.title = 'Last result ' + age + 's ago';
+            td.classList.toggle('aged', age > table.dataset.coverage);
+        }
+
+        function markAges() {
+            document.querySelectorAll('td[data-last]').forEach(markAge);
+        }
+
+        // Server push: a snapshot event re-renders the page, delta events only patch changed cells
+        function connectStream() {
+            const source = new EventSource('/status_stream');
+            let loading = false;
+            let pending = [];
+            source.addEventListener('snapshot', event => {
+                const snapshot = JSON.parse(event.data);
+                clockOffset = snapshot.time - Date.now() / 1000;
+                loading = true;
+                pending = [];
+                loadContent().then(() => {
+                    snapshot.cells.forEach(updateCell);
+                    pending.forEach(updateCell);
+                    loading = false;
                 });
+            });
+            source.addEventListener('delta', event => {
+                const delta = JSON.parse(event.data);
+                clockOffset = delta.time - Date.now() / 1000;
+                if (loading) {
+                    pending.push(...delta.cells);
+                } else {
+                    delta.cells.forEach(updateCell);
+                }
+            });
         }
 
         function startTests() {
@@ -144,10 +1143,16 @@ index_html = """
             });
         }
 
-        // Initial load
-        loadContent();
-        // Refresh content every 5 seconds
-        setInterval(loadContent, 5000);
+        if (window.EventSource) {
+            connectStream();
+        } else {
+            // Initial load
+            loadContent();
+            // Refresh content every 5 seconds
+            setInterval(loadContent, 5000);
+        }
+        // Cells age without any new result, so refresh their age on a timer
+        setInterval(markAges, 5000);
     </script>
 </body>
 </html>
@@ -155,50 +1160,40 @@ index_html = """
 
 status_html = """
 {% if clients %}
-    <table>
+    {% if coverage %}
+    <p>Sampling: each node probes {{ sample_targets }} of its {{ clients|length - 1 }} peers per {{ sample_epoch }}s, so every pair is probed at least every {{ coverage }}s. Faded cells haven't had a result for longer than that.</p>
+    {% endif %}
+    <table id="status-table"{% if coverage %} data-coverage="{{ coverage }}"{% endif %}>
         <tr>
             <th>Node</th>
             {% for hostname in clients|sort %}
-            <th>{{ hostname }}</th>
+            <th{% if clients[hostname].stale %} class="stale" title="No heartbeat from this node"{% endif %}>{{ hostname }}</th>
             {% endfor %}
         </tr>
         {% for node1 in clients|sort %}
         <tr>
-            <td>{{ node1 }}</td>
+            <td{% if clients[node1].stale %} class="stale" title="No heartbeat from this node"{% endif %}>{{ node1 }}</td>
             {% for node2 in clients|sort %}
                 {% if node1 == node2 %}
                     <td>-</td>
                 {% else %}
                     {% set result = test_results.get(node1, {}).get(node2, {'success': 0, 'fail': 0}) %}
                     {% if result.fail == 0 %}
-                        <td class="green-bg">
-                            <a href="{{ url_for('detailed_results', node1=node1, node2=node2) }}">
-                                <span class="green-text">{{ result.success }}</span> /
-                                <span class="red-text">{{ result.fail }}</span>
-                            </a>
-                        </td>
+                        {% set cell_class = 'green-bg' %}
                     {% elif result.fail >= 1 and result.fail <= 5 %}
-                        <td class="orange-bg">
-                            <a href="{{ url_for('detailed_results', node1=node1, node2=node2) }}">
-                                <span class="green-text">{{ result.success }}</span> /
-                                <span class="red-text">{{ result.fail }}</span>
-                            </a>
-                        </td>
+                        {% set cell_class = 'orange-bg' %}
                     {% elif result.fail > 5 %}
-                        <td class="red-bg">
-                            <a href="{{ url_for('detailed_results', node1=node1, node2=node2) }}">
-                                <span class="green-text">{{ result.success }}</span> /
-                                <span class="red-text">{{ result.fail }}</span>
-                            </a>
-                        </td>
+                        {% set cell_class = 'red-bg' %}
                     {% else %}
-                        <td>
-                            <a href="{{ url_for('detailed_results', node1=node1, node2=node2) }}">
-                                <span class="green-text">{{ result.success }}</span> /
-                                <span class="red-text">{{ result.fail }}</span>
-                            </a>
-                        </td>
+                        {% set cell_class = '' %}
                     {% endif %}
+                    {% set last = last_results.get(node1, {}).get(node2) %}
+                    <td id="cell|{{ node1 }}|{{ node2 }}" class="{{ cell_class }}"{% if last %} data-last="{{ last }}"{% endif %}>
+                        <a href="{{ url_for('detailed_results', node1=node1, node2=node2) }}">
+                            <span class="green-text">{{ result.success }}</span> /
+                            <span class="red-text">{{ result.fail }}</span>
+                        </a>
+                    </td>
                 {% endif %}
             {% endfor %}
         </tr>
@@ -282,15 +1277,30 @@ detailed_html = """
         {% if traceroutes.additional %}
             <h2>Additional Traceroutes</h2>
             {% for trace in traceroutes.additional %}
-                <h3>Timestamp: {{ trace.timestamp }}</h3>
+                <h3>Timestamp: {{ trace.timestamp }}{% if trace.path_changed %} (path changed){% endif %}</h3>
                 <pre>{{ trace.output }}</pre>
             {% endfor %}
         {% endif %}
         {% if traceroutes.final %}
-            <h2>Final Traceroute</h2>
+            <h2>Final Traceroute{% if traceroutes.final_path_changed %} (path changed){% endif %}</h2>
             <pre>{{ traceroutes.final }}</pre>
         {% endif %}
     {% endif %}
+    {% if pagination %}
+        <form method="get">
+            From <input type="text" name="from" value="{{ pagination['from'] }}" placeholder="YYYY-MM-DD HH:MM:SS" />
+            To <input type="text" name="to" value="{{ pagination['to'] }}" placeholder="YYYY-MM-DD HH:MM:SS" />
+            <label><input type="checkbox" name="failures" value="1" {{ 'checked' if pagination.failures }} /> Failures only</label>
+            <input type="hidden" name="limit" value="{{ pagination.limit }}" />
+            <button type="submit">Filter</button>
+        </form>
+        <p>
+            Showing {{ pagination.first }}-{{ pagination.last }} of {{ pagination.total }} entries (page {{ pagination.page }} of {{ pagination.pages }})
+            {% if pagination.prev_url %}<a href="{{ pagination.prev_url }}">Previous</a>{% endif %}
+            {% if pagination.next_url %}<a href="{{ pagination.next_url }}">Next</a>{% endif %}
+            <a href="{{ pagination.json_url }}">JSON</a>
+        </p>
+    {% endif %}
     <table>
         <tr>
             <th>Timestamp</th>
@@ -421,200 +1431,1014 @@ html_summary_template = """
 </html>
 """
 
+# Copies of the shared state for readers, taken without holding up ingest
+def clients_snapshot():
+    with structure_lock:
+        return {hostname: client_info(hostname) for hostname in clients}
+
+# Roster entry of a client; call with structure_lock held
+def client_info(hostname):
+    info = dict(clients[hostname])
+    if hostname in stale_clients:
+        info['stale'] = True
+    return info
+
+# Roster versions carry the boot id, so a restarted server never takes a
+# version handed out by a previous run for one of its own
+def roster_tag():
+    return f"{BOOT_ID}-{roster_version}"
+
+def roster_changed(hostname):
+    # Call with structure_lock held
+    global roster_version
+    roster_version += 1
+    roster_journal.append((roster_version, hostname))
+
+# The whole roster, or only the entries changed since the version a client
+# holds when the journal still covers it. Removed clients map to None.
+def roster_response(since=None):
+    with structure_lock:
+        tag = roster_tag()
+        if since == tag:
+            return {'version': tag, 'changes': {}}
+        boot_id, _, version = (since or '').partition('-')
+        if boot_id == BOOT_ID and version.isdigit() and roster_journal and int(version) >= roster_journal[0][0] - 1:
+            changed = {hostname for number, hostname in roster_journal if number > int(version)}
+            return {'version': tag, 'changes': {hostname: client_info(hostname) if hostname in clients else None
+                                                for hostname in changed}}
+        return {'version': tag, 'clients': {hostname: client_info(hostname) for hostname in clients}}
+
+# Peers a client probes during a sampling epoch, None for the full mesh; call
+# with structure_lock held. Epoch e hands the client at position i of the
+# sorted roster the SAMPLE_TARGETS peers at offsets e * SAMPLE_TARGETS + 1 ...
+# from it, wrapping around. The offsets are the same for every client, so
+# each node is also probed by exactly SAMPLE_TARGETS peers per epoch.
+def sample_targets(hostname, epoch):
+    global sorted_roster
+    if sorted_roster[0] != roster_version:
+        sorted_roster = (roster_version, sorted(clients))
+    hostnames = sorted_roster[1]
+    peers = len(hostnames) - 1
+    if SAMPLE_TARGETS <= 0 or peers <= SAMPLE_TARGETS or hostname not in clients:
+        return None
+    index = bisect_left(hostnames, hostname)
+    start = epoch * SAMPLE_TARGETS
+    return [hostnames[(index + 1 + (start + offset) % peers) % len(hostnames)]
+            for offset in range(SAMPLE_TARGETS)]
+
+# Seconds until every ordered pair has been probed once under sampling, None
+# for the full mesh
+def coverage_cycle(client_count):
+    peers = client_count - 1
+    if SAMPLE_TARGETS <= 0 or peers <= SAMPLE_TARGETS:
+        return None
+    return math.ceil(peers / SAMPLE_TARGETS) * SAMPLE_EPOCH
+
+# A client's targets for the current epoch, and how long until the next one.
+# Epochs follow the server's wall clock so all clients rotate together.
+def targets_response(hostname):
+    now = time.time()
+    epoch = int(now // SAMPLE_EPOCH)
+    with structure_lock:
+        targets = sample_targets(hostname, epoch)
+    return {'epoch': epoch, 'expires_in': round((epoch + 1) * SAMPLE_EPOCH - now, 3), 'targets': targets}
+
+def results_snapshot():
+    with structure_lock:
+        return {node1: {node2: dict(counts) for node2, counts in targets.items()}
+                for node1, targets in test_results.items()}
+
+# Templates rendered outside of a request, compiled once
+detailed_template = Template(detailed_html)
+summary_template = Template(html_summary_template)
+
 # Route to render the main page
 @app.route('/')
 def index():
     return render_template_string(index_html, url_for=url_for)
 
+# Serve a dashboard fragment from fragment_cache, rendering it only when the
+# results version moved on, and answer conditional requests with a 304
+def cached_fragment(name, render):
+    version = results_version
+    etag = f"{BOOT_ID}-{name}-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cached = fragment_cache.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, render())
+            fragment_cache[name] = cached
+        response = make_response(cached[1])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 # Route to get dynamic content
 @app.route('/get_status')
 def get_status():
-    return render_template_string(status_html, clients=clients, test_results=test_results, url_for=url_for)
+    def render():
+        snapshot = clients_snapshot()
+        return render_template_string(status_html, clients=snapshot, test_results=results_snapshot(),
+                                      last_results=last_results_snapshot(), coverage=coverage_cycle(len(snapshot)), sample_targets=SAMPLE_TARGETS,
+                                      sample_epoch=SAMPLE_EPOCH, url_for=url_for)
+    return cached_fragment('status', render)
 
 # Route to get the buttons based on the server state
 @app.route('/get_buttons')
 def get_buttons():
-    return render_template_string(buttons_html, running_tests=running_tests, test_results=test_results, url_for=url_for)
+    return cached_fragment('buttons', lambda: render_template_string(
+        buttons_html, running_tests=running_tests, test_results=bool(test_results), url_for=url_for))
+
+# Record a change to the status matrix and wake up /status_stream listeners.
+# Pass the changed (node1, node2) cells, or None to force a full snapshot.
+def mark_results_changed(cells=None):
+    global results_version, resync_version, journal_floor
+    with results_condition:
+        results_version += 1
+        if cells is None:
+            resync_version = results_version
+        else:
+            for node1, node2 in cells:
+                if len(results_journal) == results_journal.maxlen:
+                    journal_floor = results_journal[0][0]
+                results_journal.append((results_version, node1, node2))
+        results_condition.notify_all()
+
+# Epoch second of a pair's newest result, None before its first one
+def last_result(node1, node2):
+    pair = test_history.get(f"{node1}_{node2}")
+    return pair.get('last') or None if pair else None
+
+def last_results_snapshot():
+    with structure_lock:
+        return {node1: {node2: last_result(node1, node2) for node2 in targets}
+                for node1, targets in test_results.items()}
+
+def cell_entry(node1, node2):
+    result = test_results.get(node1, {}).get(node2, {'success': 0, 'fail': 0})
+    return [node1, node2, result['success'], result['fail'], last_result(node1, node2)]
+
+def status_snapshot():
+    results = results_snapshot()
+    return {
+        'version': results_version,
+        'time': time.time(),
+        'running_tests': running_tests,
+        'clients': sorted(clients_snapshot()),
+        'cells': [[node1, node2, counts['success'], counts['fail'], last_result(node1, node2)]
+                  for node1, targets in results.items() for node2, counts in targets.items()]
+    }
+
+def status_delta(since_version):
+    changed = set()
+    for version, node1, node2 in reversed(results_journal):
+        if version <= since_version:
+            break
+        changed.add((node1, node2))
+    return {
+        'version': results_version,
+        'time': time.time(),
+        'cells': [cell_entry(node1, node2) for node1, node2 in changed]
+    }
+
+# Server-sent event stream of the status matrix: one full snapshot, then only
+# the cells whose counts changed since the previous event
+@app.route('/status_stream')
+def status_stream():
+    def generate():
+        last_version = None
+        while True:
+            with results_condition:
+                if last_version == results_version:
+                    results_condition.wait(STATUS_STREAM_KEEPALIVE)
+                if last_version is None or last_version < resync_version or last_version < journal_floor:
+                    event, payload = 'snapshot', status_snapshot()
+                elif last_version != results_version:
+                    event, payload = 'delta', status_delta(last_version)
+                else:
+                    event, payload = None, None
+                last_version = results_version
+            if event:
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+            else:
+                yield ": keepalive\n\n"
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Time-bucketed aggregates of a pair at one resolution, ?resolution=<seconds>
+# must be one of ROLLUP_RESOLUTIONS; from/to as for the detailed results
+@app.route('/api/rollups/<node1>/<path:node2>')
+def rollups_api(node1, node2):
+    resolution = request.args.get('resolution', 60, type=int)
+    if resolution not in dict(ROLLUP_RESOLUTIONS):
+        return jsonify({'status': 'error', 'message': 'Invalid resolution'}), 400
+    try:
+        start_time = parse_time_arg(request.args.get('from'))
+        end_time = parse_time_arg(request.args.get('to'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid time range'}), 400
+    key = f"{node1}_{node2}"
+    data = test_history.get(key)
+    rollups = data['rollups'] if data else PairRollups()
+    with pair_lock(key):
+        buckets, summary = rollups.query(resolution, start_time, end_time)
+    return jsonify({'node1': node1, 'node2': node2, 'resolution': resolution,
+                    'buckets': buckets, 'summary': summary})
+
+def parse_time_arg(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return parse_timestamp(value)
+
+# Page of a pair's history selected by the page, limit, from, to and failures
+# query arguments; from/to take an epoch or a 'YYYY-MM-DD HH:MM:SS' timestamp
+def query_history(node1, node2):
+    key = f"{node1}_{node2}"
+    data = test_history.get(key, {'history': PairHistory(), 'traceroutes': {}})
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = min(max(request.args.get('limit', DETAIL_PAGE_SIZE, type=int), 1), DETAIL_PAGE_SIZE_MAX)
+    filters = {
+        'from': request.args.get('from', ''),
+        'to': request.args.get('to', ''),
+        'failures': '1' if request.args.get('failures') in ('1', 'true', 'on') else ''
+    }
+    start_time, end_time = parse_time_arg(filters['from']), parse_time_arg(filters['to'])
+    with pair_lock(key):
+        total, history = data['history'].query(start_time, end_time, bool(filters['failures']),
+                                               (page - 1) * limit, limit)
+        traceroutes = copy_traceroutes(data.get('traceroutes', {}))
+    params = {name: value for name, value in filters.items() if value}
+    params['limit'] = limit
+    pages = max((total + limit - 1) // limit, 1)
+    pagination = dict(filters, page=page, pages=pages, limit=limit, total=total,
+                      first=(page - 1) * limit + 1 if history else 0, last=(page - 1) * limit + len(history))
+    pagination['prev_url'] = url_for('detailed_results', node1=node1, node2=node2, page=page - 1, **params) if page > 1 else None
+    pagination['next_url'] = url_for('detailed_results', node1=node1, node2=node2, page=page + 1, **params) if page < pages else None
+    pagination['json_url'] = url_for('detailed_results_api', node1=node1, node2=node2, page=page, **params)
+    return history, traceroutes, pagination
 
 # Endpoint for detailed results between two nodes
 @app.route('/detailed_results/<node1>/<path:node2>')
 def detailed_results(node1, node2):
-    key = f"{node1}_{node2}"
-    data = test_history.get(key, {'history': [], 'traceroutes': {}})
-    history = data['history']
-    traceroutes = data.get('traceroutes', {})
-    return render_template_string(detailed_html, node1=node1, node2=node2, history=history, traceroutes=traceroutes, url_for=url_for)
+    try:
+        history, traceroutes, pagination = query_history(node1, node2)
+    except ValueError:
+        return 'Invalid time range', 400
+    return render_template_string(detailed_html, node1=node1, node2=node2, history=history, traceroutes=traceroutes,
+                                  pagination=pagination, url_for=url_for)
 
-# Endpoint for clients to register themselves
-@app.route('/register', methods=['POST'])
-def register():
-    data = request.get_json()
-    hostname = data.get('hostname')
-    ip_address = data.get('ip_address')
+# JSON version of the detailed results page, same query arguments
+@app.route('/api/detailed_results/<node1>/<path:node2>')
+def detailed_results_api(node1, node2):
+    try:
+        history, traceroutes, pagination = query_history(node1, node2)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid time range'}), 400
+    return jsonify({
+        'node1': node1,
+        'node2': node2,
+        'page': pagination['page'],
+        'pages': pagination['pages'],
+        'limit': pagination['limit'],
+        'total': pagination['total'],
+        'history': history,
+        'traceroutes': traceroutes
+    })
+
+# Hops of a stored traceroute path, as referenced by the path ids in the
+# detailed results. Paths kept verbatim have no hops, only their text.
+@app.route('/api/paths/<path_id>')
+def path_api(path_id):
+    path = trace_paths.get(path_id)
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'Unknown path'}), 404
+    if path.raw is not None:
+        return jsonify({'path_id': path_id, 'hops': None, 'output': path.raw})
+    return jsonify({'path_id': path_id, 'header': path.header,
+                    'hops': [{'hop': ttl, 'ip': hop[0] if hop else None, 'flag': hop[1].strip() if hop else None}
+                             for ttl, hop in enumerate(path.hops, 1)]})
+
+# Client-facing request handlers shared by the Flask views and async_server.py.
+# Each returns a (JSON payload, HTTP status) pair.
+# Heartbeat from a client. Only touches last_seen unless the client is new
+# to the liveness checks or comes back from being stale.
+def client_seen(hostname):
+    if hostname not in clients:
+        return
+    now = time.monotonic()
+    known = hostname in last_seen
+    last_seen[hostname] = now
+    if known and hostname not in stale_clients:
+        return
+    with liveness_lock:
+        arm_liveness_check(hostname, now + CLIENT_STALE_AFTER)
+        if hostname in stale_clients:
+            with structure_lock:
+                stale_clients.discard(hostname)
+                roster_changed(hostname)
+            print(f"Client {hostname} is alive again.")
+            mark_results_changed()
+
+# Call with liveness_lock held
+def arm_liveness_check(hostname, deadline):
+    liveness_due[hostname] = deadline
+    heapq.heappush(liveness_heap, (deadline, hostname))
+
+# Run the liveness checks that came due: mark clients stale or evict them,
+# and re-arm the checks of clients that were heard from in the meantime
+def check_liveness():
+    now = time.monotonic()
+    with liveness_lock:
+        while liveness_heap and liveness_heap[0][0] <= now:
+            deadline, hostname = heapq.heappop(liveness_heap)
+            if liveness_due.get(hostname) != deadline:
+                continue
+            seen = last_seen.get(hostname)
+            if seen is None or hostname not in clients:
+                liveness_due.pop(hostname, None)
+                last_seen.pop(hostname, None)
+                continue
+            if now - seen >= CLIENT_EVICT_AFTER:
+                del liveness_due[hostname]
+                del last_seen[hostname]
+                with state_lock.shared():
+                    apply_evict(hostname)
+                    log_change(OP_EVICT, hostname.encode())
+                print(f"Client {hostname} evicted after {now - seen:.0f}s without a heartbeat.")
+            elif now - seen >= CLIENT_STALE_AFTER:
+                if hostname not in stale_clients:
+                    with structure_lock:
+                        stale_clients.add(hostname)
+                        roster_changed(hostname)
+                    print(f"Client {hostname} is stale, no heartbeat for {now - seen:.0f}s.")
+                    mark_results_changed()
+                arm_liveness_check(hostname, seen + CLIENT_EVICT_AFTER)
+            else:
+                arm_liveness_check(hostname, seen + CLIENT_STALE_AFTER)
+
+def liveness_loop():
+    while True:
+        time.sleep(LIVENESS_CHECK_INTERVAL)
+        try:
+            check_liveness()
+        except Exception as e:
+            print(f"Error checking client liveness: {e}")
+
+# Recovered clients get a full grace period, then liveness is checked in the background
+def start_liveness_checks():
+    for hostname in list(clients):
+        client_seen(hostname)
+    threading.Thread(target=liveness_loop, name='liveness', daemon=True).start()
+
+def handle_register(data):
+    hostname = (data or {}).get('hostname')
+    ip_address = (data or {}).get('ip_address')
     if hostname and ip_address:
-        clients[hostname] = {'ip_address': ip_address}
+        with state_lock.shared():
+            apply_register(hostname, ip_address)
+            log_change(OP_REGISTER, json.dumps({'hostname': hostname, 'ip_address': ip_address}).encode())
+        client_seen(hostname)
         print(f"Client registered: {hostname} ({ip_address})")
-        return jsonify({'status': 'registered'})
+        return {'status': 'registered'}, 200
     else:
-        return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
+        return {'status': 'error', 'message': 'Invalid data'}, 400
 
-# Endpoint to start connectivity tests
-@app.route('/start_tests', methods=['POST'])
-def start_tests():
+def decode_body(body, content_encoding):
+    if content_encoding == 'gzip':
+        return gzip.decompress(body)
+    return body
+
+# Bodies are parsed and validated whole before any of it is applied, so a
+# malformed entry is rejected without leaving the state half changed or out of
+# step with the log
+def handle_report(body, content_encoding=None):
+    try:
+        data = json.loads(decode_body(body, content_encoding))
+        hostname, rounds = parse_report(data)
+    except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError):
+        return {'status': 'error', 'message': 'Invalid data'}, 400
+    with state_lock.shared():
+        count = apply_report(hostname, rounds)
+        log_change(OP_REPORT, json.dumps(data).encode())
+    client_seen(hostname)
+    record_ingest(hostname, count, data.get('timings'))
+    return {'status': 'results_received'}, 200
+
+def handle_ingest(body, content_encoding=None):
+    try:
+        body = decode_body(body, content_encoding)
+        header, batch = parse_records(body)
+    except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError):
+        return {'status': 'error', 'message': 'Invalid data'}, 400
+    with state_lock.shared():
+        applied = claim_batch(header['hostname'], header.get('batch'))
+        if applied:
+            count = apply_records(header, batch)
+            log_change(OP_INGEST, body)
+    client_seen(header['hostname'])
+    if not applied:
+        # A retry after the response to the first attempt got lost
+        return {'status': 'results_received', 'records': 0, 'duplicate': True}, 200
+    record_ingest(header['hostname'], count, header.get('timings'))
+    return {'status': 'results_received', 'records': count}, 200
+
+# Heartbeat of a command poll, returns the re_register command for unknown
+# clients. Not to be called with commands_condition held: the liveness checks
+# take it while holding liveness_lock.
+def command_check_in(hostname):
+    if hostname not in clients:
+        print(f"Client {hostname} is not registered. Sending re_register command.")
+        return {'command': 're_register'}
+    client_seen(hostname)
+    return None
+
+# Non-blocking half of /get_commands: the command waiting for a client, a
+# re_register for unknown clients, or None when there is nothing to do yet
+def take_command(hostname):
+    command = command_check_in(hostname)
+    if command is None:
+        with commands_condition:
+            command = client_commands.pop(hostname, None)
+    return command
+
+# Command poll answers also carry the roster version, so clients only call
+# /get_clients when the roster actually changed
+def command_payload(command):
+    return dict(command or {'command': None}, roster_version=roster_tag())
+
+def command_wait(value):
+    try:
+        return min(max(float(value or 0), 0), COMMAND_WAIT_MAX)
+    except ValueError:
+        return 0
+
+# Endpoint for clients to register themselves
+@app.route('/register', methods=['POST'])
+def register():
+    payload, status = handle_register(request.get_json(silent=True))
+    return jsonify(payload), status
+
+# State changes shared by the endpoints and log replay
+def apply_register(hostname, ip_address):
+    info = {'ip_address': ip_address}
+    with structure_lock:
+        if clients.get(hostname) == info:
+            return
+        clients[hostname] = info
+        roster_changed(hostname)
+    mark_results_changed()
+
+# Drop a client from the roster; its results and history stay
+def apply_evict(hostname):
+    with structure_lock:
+        if clients.pop(hostname, None) is None:
+            return
+        stale_clients.discard(hostname)
+        roster_changed(hostname)
+    with commands_condition:
+        client_commands.pop(hostname, None)
+    mark_results_changed()
+
+def apply_start_tests():
     global running_tests, test_results, test_history, current_test_name
-    if test_results:
-        return jsonify({'status': 'error', 'message': 'Please download or clear previous test data before starting a new test.'}), 400
     running_tests = True
-    test_results.clear()
-    test_history.clear()
+    with structure_lock:
+        test_results.clear()
+        test_history.clear()
+        trace_paths.clear()
+    current_test_name = ''
+    mark_results_changed()
+
+def apply_stop_tests():
+    global running_tests
+    running_tests = False
+    mark_results_changed()
+
+def apply_clear_data():
+    global test_results, test_history, current_test_name
+    with structure_lock:
+        test_results.clear()
+        test_history.clear()
+        trace_paths.clear()
     current_test_name = ''
-    for hostname in clients:
-        client_commands[hostname] = {'command': 'start_tests'}
+    mark_results_changed()
+
+# Endpoint to start connectivity tests
+@app.route('/start_tests', methods=['POST'])
+def start_tests():
+    with state_lock.exclusive():
+        if test_results:
+            return jsonify({'status': 'error', 'message': 'Please download or clear previous test data before starting a new test.'}), 400
+        apply_start_tests()
+        log_change(OP_START)
+    queue_command('start_tests')
     print("Continuous tests started.")
     return jsonify({'status': 'tests_started'})
 
 # Endpoint to stop connectivity tests
 @app.route('/stop_tests', methods=['POST'])
 def stop_tests():
-    global running_tests
-    running_tests = False
-    for hostname in clients:
-        client_commands[hostname] = {'command': 'stop_tests'}
+    with state_lock.shared():
+        apply_stop_tests()
+        log_change(OP_STOP)
+    queue_command('stop_tests')
     print("Tests stopped.")
     return jsonify({'status': 'tests_stopped'})
 
 # Endpoint to clear test data
 @app.route('/clear_data', methods=['POST'])
 def clear_data():
-    global test_results, test_history, current_test_name
-    test_results.clear()
-    test_history.clear()
-    current_test_name = ''
+    with state_lock.exclusive():
+        apply_clear_data()
+        log_change(OP_CLEAR)
     print("Test data cleared.")
     return jsonify({'status': 'data_cleared'})
 
+# Queue a command for every registered client and wake up waiting long-polls.
+# Callables in command_listeners are invoked too, for waiters that don't block
+# on commands_condition (the async server's event loop).
+command_listeners = []
+
+def queue_command(command):
+    hostnames = list(clients_snapshot())
+    with commands_condition:
+        for hostname in hostnames:
+            client_commands[hostname] = {'command': command}
+        commands_condition.notify_all()
+    for listener in command_listeners:
+        listener()
+
 # Endpoint for clients to get commands
+# With ?wait=<seconds> the request is held open until a command is queued for
+# the client or the wait expires, so idle clients don't need to poll.
 @app.route('/get_commands', methods=['GET'])
 def get_commands():
     hostname = request.args.get('hostname')
-    if hostname not in clients:
-        print(f"Client {hostname} is not registered. Sending re_register command.")
-        return jsonify({'command': 're_register'})
-    elif hostname in client_commands:
-        command = client_commands.pop(hostname)
-        return jsonify(command)
+    deadline = time.monotonic() + command_wait(request.args.get('wait'))
+    command = command_check_in(hostname)
+    # Look for a command under the condition before every wait, so one queued
+    # at any point after the check-in is either found or wakes us up
+    with commands_condition:
+        if command is None:
+            command = client_commands.pop(hostname, None)
+        while command is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            commands_condition.wait(remaining)
+            command = client_commands.pop(hostname, None)
+    return jsonify(command_payload(command))
+
+# Counts cell, history entry and lock of a node pair, created on first use.
+# The counts and history may only be changed while holding the lock.
+def pair_entry(hostname, target):
+    key = f"{hostname}_{target}"
+    pair = test_history.get(key)
+    if pair is None:
+        with structure_lock:
+            if hostname not in test_results:
+                test_results[hostname] = {}
+            if target not in test_results[hostname]:
+                test_results[hostname][target] = {'success': 0, 'fail': 0}
+            if key not in test_history:
+                # last: epoch second of the newest result, kept out of the exported counts
+                test_history[key] = {'history': PairHistory(), 'rollups': PairRollups(), 'last': 0,
+                                     'traceroutes': {'initial': None, 'additional': [], 'final': None}}
+            pair = test_history[key]
+    return test_results[hostname][target], pair, pair_lock(key)
+
+# Rendered traceroutes of a pair with their path ids. A traceroute is marked
+# path_changed when its path differs from the one traced before it.
+def copy_traceroutes(traceroutes):
+    initial, final = traceroutes.get('initial'), traceroutes.get('final')
+    previous = initial
+    additional = []
+    for timestamp, trace in traceroutes.get('additional', []):
+        additional.append({
+            'timestamp': timestamp,
+            'output': render_traceroute(trace),
+            'path_id': trace[0] if trace else None,
+            'path_changed': bool(previous and trace and previous[0] != trace[0])
+        })
+        previous = trace or previous
+    return {
+        'initial': render_traceroute(initial),
+        'initial_path_id': initial[0] if initial else None,
+        'additional': additional,
+        'final': render_traceroute(final),
+        'final_path_id': final[0] if final else None,
+        'final_path_changed': bool(previous and final and previous[0] != final[0])
+    }
+
+def add_result(counts, pair, timestamp, success, latency, source_ip, destination_ip):
+    # Update counts and the epoch second of the pair's newest result
+    if success:
+        counts['success'] += 1
     else:
-        return jsonify({'command': None})
+        counts['fail'] += 1
+    if timestamp > pair.get('last', 0):
+        pair['last'] = int(timestamp)
+    # Update test history
+    pair['history'].append(timestamp, success, latency, source_ip, destination_ip)
+    pair['rollups'].add(timestamp, success, latency)
+
+# Merge a client-side window aggregate (see RECORD_AGGREGATE). The history
+# gets every failure at its exact time and one success entry at the end of the
+# window carrying the average latency; the rollups get the whole window.
+# Histogram keys are LatencySketch buckets for the client's gamma; they are
+# re-bucketed if that differs from ours.
+def add_aggregate(counts, pair, record, source_ip, destination_ip, gamma=SKETCH_GAMMA):
+    window_start, window, sent, lost, minimum, average, maximum, jitter, histogram, failures = record[2:12]
+    counts['success'] += sent - lost
+    counts['fail'] += lost
+    pair['last'] = int(max([pair.get('last', 0), window_start + window - 1] + failures))
+    history = pair['history']
+    for timestamp in sorted(failures):
+        history.append(timestamp, False, None, source_ip, destination_ip)
+    if sent > lost:
+        history.append(max([window_start + window - 1] + failures), True, average, source_ip, destination_ip)
+    bucket = RollupBucket()
+    bucket.count, bucket.lost, bucket.min, bucket.max = sent, lost, minimum, maximum
+    for key, count in histogram:
+        if gamma == SKETCH_GAMMA:
+            bucket.sketch.buckets[key] = bucket.sketch.buckets.get(key, 0) + count
+            bucket.sketch.count += count
+        else:
+            bucket.sketch.add(2 * gamma ** key / (gamma + 1), count)
+    if average is not None:
+        bucket.total = average * bucket.sketch.count
+    if jitter is not None:
+        bucket.jitter_total = jitter * bucket.sketch.count
+        bucket.jitter_weight = bucket.sketch.count
+    pair['rollups'].add_bucket(window_start, bucket)
+
+def add_traceroute(pair, kind, trace_output, timestamp=None):
+    if kind == 'additional':
+        pair['traceroutes']['additional'].append(
+            (timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S'), intern_traceroute(trace_output)))
+    elif kind in ('initial', 'final'):
+        pair['traceroutes'][kind] = intern_traceroute(trace_output)
+
+TRACEROUTE_KINDS = ('initial', 'additional', 'final')
+
+# Validation helpers for client input; NaN, infinities and booleans are not numbers
+def is_number(value):
+    try:
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+    except OverflowError:
+        return False
+
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def is_epoch(value):
+    # Anything time.localtime can format
+    return is_number(value) and 0 <= value < 253402300800
+
+def is_address(value):
+    return value is None or isinstance(value, str)
+
+def require(condition, message='Invalid data'):
+    if not condition:
+        raise ValueError(message)
+
+# Validated rounds of a /report_results body as (results, traceroutes,
+# round_timestamp), results as (target, epoch, success, latency, source_ip,
+# destination_ip) and traceroutes as (kind, target, output). Raises on anything
+# malformed.
+def parse_report(data):
+    require(isinstance(data, dict) and isinstance(data.get('hostname'), str) and data['hostname'])
+    rounds = data.get('rounds')
+    if rounds is None:
+        rounds = [data]
+    require(isinstance(rounds, list))
+    parsed = []
+    for round_data in rounds:
+        require(isinstance(round_data, dict))
+        results = round_data.get('results') or {}
+        traceroutes = round_data.get('traceroutes') or {}
+        require(isinstance(results, dict) and isinstance(traceroutes, dict))
+        round_results = []
+        for target, result_info in results.items():
+            require(isinstance(result_info, dict) and isinstance(result_info.get('timestamp'), str))
+            latency = result_info.get('latency')
+            require(latency is None or is_number(latency), 'Invalid latency')
+            require(is_address(result_info['source_ip']) and is_address(result_info['destination_ip']))
+            round_results.append((target, parse_timestamp(result_info['timestamp']), result_info['result'] == 'Success',
+                                  latency, result_info['source_ip'], result_info['destination_ip']))
+        round_traceroutes = []
+        for kind in TRACEROUTE_KINDS:
+            outputs = traceroutes.get(kind) or {}
+            require(isinstance(outputs, dict))
+            for target, trace_output in outputs.items():
+                require(isinstance(trace_output, str))
+                round_traceroutes.append((kind, target, trace_output))
+        parsed.append((round_results, round_traceroutes, round_data.get('timestamp')))
+    return data['hostname'], parsed
+
+# Apply one validated round of results and traceroutes from a client, returns
+# the (node1, node2) cells it changed
+def ingest_round(hostname, results, traceroutes, round_timestamp=None):
+    # Process test results
+    for target, timestamp, success, latency, source_ip, destination_ip in results:
+        counts, pair, lock = pair_entry(hostname, target)
+        with lock:
+            preserve_pair(f"{hostname}_{target}", pair)
+            add_result(counts, pair, timestamp, success, latency, source_ip, destination_ip)
+    # Process traceroutes
+    for kind, target, trace_output in traceroutes:
+        _, pair, lock = pair_entry(hostname, target)
+        # Buffered rounds carry the time they were taken
+        with lock:
+            preserve_pair(f"{hostname}_{target}", pair)
+            add_traceroute(pair, kind, trace_output, round_timestamp)
+    return [(hostname, result[0]) for result in results]
+
+# Compact ingest format for /ingest, one JSON document per line:
+#   {"hostname": ..., "source_ip": ..., "targets": [[hostname, ip], ...]}
+#   [RECORD_RESULT, target_index, epoch_seconds, ok, latency]
+#   [RECORD_TRACEROUTE, target_index, kind, epoch_seconds, output]
+#   [RECORD_AGGREGATE, target_index, window_start, window_seconds, sent, lost,
+#    min, avg, max, jitter, [[sketch_bucket, count], ...], [failure_epoch, ...]]
+# Batches with aggregates name the client's sketch accuracy in the header as
+# "sketch_accuracy". A "batch" id in the header makes retries safe, see
+# claim_batch().
+# The header is resolved to counts cells and history entries once per batch,
+# so every record after it is applied without any dict lookups by name, and
+# records are grouped per pair so each pair lock is taken once per batch.
+RECORD_RESULT = 0
+RECORD_TRACEROUTE = 1
+RECORD_AGGREGATE = 2
+
+# Id of the last /ingest batch applied per client. A client sends its next
+# batch only once the last one was acknowledged, and repeats the id when it
+# retries, so a batch with the same id as the last one was applied already.
+ingest_batches = {}
+ingest_batches_lock = threading.Lock()
+
+def claim_batch(hostname, batch_id):
+    # Returns False for a batch that was applied already
+    if batch_id is None:
+        return True
+    with ingest_batches_lock:
+        if ingest_batches.get(hostname) == batch_id:
+            return False
+        ingest_batches[hostname] = batch_id
+    return True
+
+def valid_record(record, log_gamma):
+    kind = record[0]
+    if kind == RECORD_RESULT:
+        return (len(record) >= 5 and is_epoch(record[2]) and record[3] in (0, 1)
+                and (record[4] is None or is_number(record[4])))
+    if kind == RECORD_TRACEROUTE:
+        return (len(record) >= 5 and record[2] in TRACEROUTE_KINDS and is_epoch(record[3])
+                and isinstance(record[4], str))
+    if kind == RECORD_AGGREGATE:
+        if len(record) < 12:
+            return False
+        window_start, window, sent, lost, minimum, average, maximum, jitter, histogram, failures = record[2:12]
+        # Histogram keys are turned back into latencies with gamma ** key, keep that finite
+        return (is_epoch(window_start) and is_number(window) and window > 0
+                and is_count(sent) and is_count(lost) and lost <= sent
+                and all(value is None or is_number(value) for value in (minimum, average, maximum, jitter))
+                and (minimum is None) == (maximum is None)
+                and isinstance(histogram, list)
+                and all(isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], int)
+                        and abs(entry[0]) * log_gamma < 700 and is_count(entry[1]) for entry in histogram)
+                and isinstance(failures, list) and all(is_epoch(timestamp) for timestamp in failures))
+    return False
+
+# Validated /ingest batch as (header, records grouped per target index);
+# record types this server doesn't know are skipped. Raises on anything malformed.
+def parse_records(body):
+    lines = [line for line in body.split(b'\n') if line.strip()]
+    if not lines:
+        raise ValueError('Empty batch')
+    header = json.loads(lines[0])
+    require(isinstance(header, dict) and isinstance(header.get('hostname'), str) and header['hostname'])
+    require(is_address(header.get('source_ip')))
+    require(header.get('batch') is None or isinstance(header['batch'], str), 'Invalid batch id')
+    targets = header['targets']
+    require(isinstance(targets, list) and all(isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], str)
+                                              and is_address(entry[1]) for entry in targets))
+    accuracy = header.get('sketch_accuracy', SKETCH_RELATIVE_ACCURACY)
+    require(is_number(accuracy) and 0 < accuracy < 1, 'Invalid sketch accuracy')
+    header['gamma'] = (1 + accuracy) / (1 - accuracy)
+    log_gamma = math.log(header['gamma'])
+    # Parse all records in a single json.loads call
+    records = json.loads(b'[' + b','.join(lines[1:]) + b']')
+    by_target = [[] for _ in targets]
+    for record in records:
+        require(isinstance(record, list) and len(record) >= 2)
+        if record[0] not in (RECORD_RESULT, RECORD_TRACEROUTE, RECORD_AGGREGATE):
+            continue
+        # Booleans are ints and negative indices would wrap around to another target
+        index = record[1]
+        require(isinstance(index, int) and not isinstance(index, bool) and 0 <= index < len(targets),
+                'Invalid target index')
+        require(valid_record(record, log_gamma), 'Invalid record')
+        by_target[index].append(record)
+    header['records'] = len(records)
+    return header, by_target
+
+def apply_records(header, by_target):
+    hostname = header['hostname']
+    source_ip = header.get('source_ip')
+    gamma = header['gamma']
+    changed = set()
+    for (target, target_ip), target_records in zip(header['targets'], by_target):
+        if not target_records:
+            continue
+        counts, pair, lock = pair_entry(hostname, target)
+        with lock:
+            preserve_pair(f"{hostname}_{target}", pair)
+            for record in target_records:
+                if record[0] == RECORD_RESULT:
+                    add_result(counts, pair, record[2], record[3], record[4], source_ip, target_ip)
+                    changed.add(target)
+                elif record[0] == RECORD_TRACEROUTE:
+                    add_traceroute(pair, record[2], record[4], format_timestamp(record[3]))
+                elif record[0] == RECORD_AGGREGATE:
+                    add_aggregate(counts, pair, record, source_ip, target_ip, gamma)
+                    changed.add(target)
+    if changed:
+        mark_results_changed([(hostname, target) for target in changed])
+    return header['records']
 
 # Endpoint for clients to report results
+# Accepts a single round or a batch of buffered rounds under 'rounds', either
+# plain or gzip-compressed (Content-Encoding: gzip)
 @app.route('/report_results', methods=['POST'])
 def report_results():
-    data = request.get_json()
-    hostname = data.get('hostname')
-    results = data.get('results')
-    traceroutes = data.get('traceroutes', {})
-    if hostname:
-        # Process test results
-        if results:
-            for target, result_info in results.items():
-                if hostname not in test_results:
-                    test_results[hostname] = {}
-                if target not in test_results[hostname]:
-                    test_results[hostname][target] = {'success': 0, 'fail': 0}
-                # Update counts
-                if result_info['result'] == 'Success':
-                    test_results[hostname][target]['success'] += 1
-                else:
-                    test_results[hostname][target]['fail'] += 1
-                # Update test history
-                key = f"{hostname}_{target}"
-                if key not in test_history:
-                    test_history[key] = {'history': [], 'traceroutes': {'initial': '', 'additional': [], 'final': ''}}
-                test_history[key]['history'].append({
-                    'timestamp': result_info['timestamp'],
-                    'result': result_info['result'],
-                    'latency': result_info.get('latency'),
-                    'source_ip': result_info['source_ip'],
-                    'destination_ip': result_info['destination_ip']
-                })
-        # Process traceroutes
-        if traceroutes:
-            initial_traces = traceroutes.get('initial', {})
-            additional_traces = traceroutes.get('additional', {})
-            final_traces = traceroutes.get('final', {})
-            for target, trace_output in initial_traces.items():
-                key = f"{hostname}_{target}"
-                if key not in test_history:
-                    test_history[key] = {'history': [], 'traceroutes': {'initial': '', 'additional': [], 'final': ''}}
-                test_history[key]['traceroutes']['initial'] = trace_output
-            for target, trace_output in additional_traces.items():
-                key = f"{hostname}_{target}"
-                if key not in test_history:
-                    test_history[key] = {'history': [], 'traceroutes': {'initial': '', 'additional': [], 'final': ''}}
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                test_history[key]['traceroutes']['additional'].append({
-                    'timestamp': timestamp,
-                    'output': trace_output
-                })
-            for target, trace_output in final_traces.items():
-                key = f"{hostname}_{target}"
-                if key not in test_history:
-                    test_history[key] = {'history': [], 'traceroutes': {'initial': '', 'additional': [], 'final': ''}}
-                test_history[key]['traceroutes']['final'] = trace_output
-        return jsonify({'status': 'results_received'})
-    else:
-        return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
+    payload, status = handle_report(request.get_data(), request.content_encoding)
+    return jsonify(payload), status
+
+def apply_report(hostname, rounds):
+    changed = []
+    for results, traceroutes, round_timestamp in rounds:
+        changed.extend(ingest_round(hostname, results, traceroutes, round_timestamp))
+    if changed:
+        mark_results_changed(changed)
+    return len(changed)
+
+# Bulk ingest endpoint for batches in the compact format above, plain or gzip
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    payload, status = handle_ingest(request.get_data(), request.content_encoding)
+    return jsonify(payload), status
+
+# Write-only file object for ZipFile; the bytes of each finished member are
+# handed to the response generator instead of collecting the whole archive
+class ZipStream:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Render the HTML and JSON members of one pair for the results archive
+def render_pair_export(key):
+    data = test_history.get(key)
+    if data is None:
+        return key, None, None
+    with pair_lock(key):
+        history = data['history'].copy()
+        traceroutes = copy_traceroutes(data.get('traceroutes', {}))
+    history = list(history)
+    # Use split with maxsplit=1 to handle underscores in hostnames
+    node1, node2 = key.split('_', 1)
+    # Generate detailed HTML
+    detailed_html_content = detailed_template.render(
+        node1=node1,
+        node2=node2,
+        history=history,
+        traceroutes=traceroutes
+    )
+    return key, detailed_html_content, json.dumps(history, indent=4)
+
+# Like pool.map, but only keeps `window` results in flight so memory stays bounded
+def bounded_map(pool, function, items, window):
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 # Endpoint to download test results
+# The archive is streamed member by member while a worker pool renders the
+# per-pair pages ahead of the writer
 @app.route('/download_results/<test_name>')
 def download_results(test_name):
-    global test_results, test_history, current_test_name
-    # Create a zip file in memory
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w') as zf:
-        # Add summary JSON
-        summary_data = {
-            'test_name': test_name,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'results': test_results
-        }
-        summary_json = json.dumps(summary_data, indent=4)
-        zf.writestr('summary.json', summary_json)
-        # Add summary HTML
-        summary_html = Template(html_summary_template).render(
-            test_name=test_name,
-            timestamp=summary_data['timestamp'],
-            clients=clients.keys(),
-            test_results=test_results
-        )
-        zf.writestr('summary.html', summary_html)
-        # Add detailed results
-        for key, data in test_history.items():
-            history = data['history']
-            traceroutes = data.get('traceroutes', {})
-            # Use split with maxsplit=1 to handle underscores in hostnames
-            node1, node2 = key.split('_', 1)
-            # Generate detailed HTML
-            detailed_html_content = Template(detailed_html).render(
-                node1=node1,
-                node2=node2,
-                history=history,
-                traceroutes=traceroutes
+    def generate():
+        stream = ZipStream()
+        results = results_snapshot()
+        with structure_lock:
+            keys = list(test_history)
+        with zipfile.ZipFile(stream, 'w') as zf:
+            # Add summary JSON
+            summary_data = {
+                'test_name': test_name,
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results
+            }
+            summary_json = json.dumps(summary_data, indent=4)
+            zf.writestr('summary.json', summary_json)
+            yield stream.drain()
+            # Add summary HTML
+            summary_html = summary_template.render(
+                test_name=test_name,
+                timestamp=summary_data['timestamp'],
+                # Evicted nodes keep their place next to the current roster
+                clients=set(clients_snapshot()) | set(results) | {node2 for targets in results.values() for node2 in targets},
+                test_results=results
             )
-            zf.writestr(f'detailed_{key}.html', detailed_html_content)
-            # Add JSON data
-            zf.writestr(f'detailed_{key}.json', json.dumps(history, indent=4))
-    memory_file.seek(0)
-    return send_file(
-        memory_file,
-        download_name=f'{test_name}.zip',
-        as_attachment=True
-    )
+            zf.writestr('summary.html', summary_html)
+            yield stream.drain()
+            # Add detailed results
+            with ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export') as pool:
+                for key, detailed_html_content, history_json in bounded_map(
+                        pool, render_pair_export, keys, EXPORT_WORKERS * 2):
+                    if detailed_html_content is None:
+                        continue
+                    zf.writestr(f'detailed_{key}.html', detailed_html_content)
+                    yield stream.drain()
+                    # Add JSON data
+                    zf.writestr(f'detailed_{key}.json', history_json)
+                    yield stream.drain()
+        # Central directory
+        yield stream.drain()
+
+    filename = f'{test_name}.zip'
+    try:
+        filename.encode('ascii')
+        disposition = 'attachment; filename="{}"'.format(filename.replace('"', '\\"'))
+    except UnicodeEncodeError:
+        disposition = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return Response(generate(), mimetype='application/zip', headers={'Content-Disposition': disposition})
+
+# Request timing for /metrics. The duration is taken when the response is
+# closed, so streamed bodies such as the results archive are included; the
+# long-lived event stream is left out.
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def time_request(response):
+    endpoint = request.endpoint or 'unmatched'
+    if endpoint != 'status_stream':
+        started = g.request_started
+        status = response.status_code
+        response.call_on_close(lambda: observe_request(endpoint, status, time.perf_counter() - started))
+    return response
 
-# Endpoint for clients to get the list of clients
+# Prometheus text exposition of request, ingest and state metrics
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Endpoint for clients to get the list of clients. With ?since=<version> only
+# the changes after that version are sent; plain requests can revalidate
+# the full roster with If-None-Match.
 @app.route('/get_clients', methods=['GET'])
 def get_clients():
-    return jsonify({'clients': clients})
+    since = request.args.get('since')
+    payload = roster_response(since)
+    if since is None and request.if_none_match.contains(payload['version']):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(payload['version'])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Endpoint for clients to get the peers to probe this sampling epoch
+@app.route('/get_targets', methods=['GET'])
+def get_targets():
+    return jsonify(targets_response(request.args.get('hostname')))
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=50000)
\ No newline at end of file
+    open_storage()
+    start_liveness_checks()
+    # Stop on SIGTERM the same way as on Ctrl+C, so the log gets flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host='0.0.0.0', port=50000)
+    finally:
+        close_storage()
\ No newline at end of file